@@ -1,10 +1,29 @@
 from importlib.resources import path
-import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing as mp
 import pathlib
+import sys
 import uuid
+from typing import Iterable, Iterator, List, Literal, Optional, Tuple, Union
 
 import numpy as np
 import pandas as pd
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+
+# plate data format and task batching shared by all modules (defined in utils/ at the root of the repository)
+sys.path.append(f"{pathlib.Path(__file__).resolve().parents[2]}/utils")
+import plate_data_utils
+import task_utils
+
+
+class CellCountMismatchError(IndexError):
+    """
+    raised when CP and DP data from the same image do not have the same number of cells
+    (they must have the same number to merge cell data)
+    """
 
 
 def format_cp_well(cp_well: str) -> str:
@@ -57,9 +76,49 @@ def format_cp_site(cp_site: str) -> str:
     return site
 
 
-def load_cp_feature_data(cp_output_path: pathlib.Path, plate: str) -> pd.DataFrame:
+def format_cp_image_data(cp_plate: pd.DataFrame, plate: str) -> pd.DataFrame:
+    """
+    helper function for load_cp_feature_data
+    add plate metadata and convert CP well and field to the formats used by DP
+
+    Parameters
+    ----------
+    cp_plate : pd.DataFrame
+        single-cell CP output with categorical Metadata_Well and Metadata_Field columns
+    plate : str
+        name of plate that features are being loaded for
+
+    Returns
+    -------
+    pd.DataFrame
+        single-cell data ready for merging with DP output
+    """
+
+    # add plate metadata
+    cp_plate["Metadata_Plate"] = pd.Categorical.from_codes(
+        np.zeros(cp_plate.shape[0], dtype=np.int8), categories=[plate]
+    )
+
+    # convert well and field to one usable for merging
+    # (only the unique categories are formatted, which works as a lookup table for every cell)
+    cp_plate["Metadata_Well"] = cp_plate["Metadata_Well"].cat.rename_categories(
+        format_cp_well
+    )
+    cp_plate["Metadata_Field"] = cp_plate["Metadata_Field"].cat.rename_categories(
+        format_cp_site
+    )
+    # rename field column to site (name used by DP)
+    cp_plate = cp_plate.rename(columns={"Metadata_Field": "Metadata_Site"})
+
+    return cp_plate
+
+
+def load_cp_feature_data(
+    cp_output_path: pathlib.Path, plate: str, chunksize: Optional[int] = None
+) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
     """
-    load CP output in format ready for merging with DP output
+    load CP output in format ready for merging with DP output.
+    features are loaded as float32 and plate, well, and site are loaded as categoricals
 
     Parameters
     ----------
@@ -67,19 +126,21 @@ def load_cp_feature_data(cp_output_path: pathlib.Path, plate: str) -> pd.DataFra
         path to CP output folder (same as that set in CP project)
     plate : str
         name of plate that features are being loaded for
+    chunksize : Optional[int], optional
+        number of cells to load at a time, by default None (load all cells at once).
+        if given, an iterator of single-cell data chunks is returned instead (for plates that do not fit in memory)
 
     Returns
     -------
-    pandas.DataFrame
-        single-cell data ready for merging with DP output
+    Union[pd.DataFrame, Iterator[pd.DataFrame]]
+        single-cell data ready for merging with DP output (or iterator of single-cell data chunks if chunksize is given)
     """
 
     # set path to plate that we want to load
     cp_plate_path = pathlib.Path(f"{cp_output_path}/Nuclei.csv")
 
-    # determine which columns to load from CP output csv
-    cp_plate_cell_1 = pd.read_csv(cp_plate_path, nrows=1)
-    all_cols = cp_plate_cell_1.columns.to_list()
+    # determine which columns to load from CP output csv (only the header is read)
+    all_cols = pd.read_csv(cp_plate_path, nrows=0).columns.to_list()
     cols_to_load = [
         "Metadata_Field",
         "Metadata_Well",
@@ -87,63 +148,228 @@ def load_cp_feature_data(cp_output_path: pathlib.Path, plate: str) -> pd.DataFra
         "Location_Center_Y",
     ]
     # We only want to get CP data from the feature modules below (_ ensures it is found as module name)
-    cp_feature_modules = [
+    cp_feature_modules = (
         "AreaShape_",
         "Granularity_",
         "Intensity_",
         "Neighbors_",
         "RadialDistribution_",
         "Texture_",
-    ]
+    )
     # remove CP columns that dont have a feature module as a substring
-    for col in all_cols:
-        if any(col.startswith(feature_module) for feature_module in cp_feature_modules):
-            cols_to_load.append(col)
+    feature_cols = [col for col in all_cols if col.startswith(cp_feature_modules)]
+    cols_to_load += feature_cols
+
+    # specify datatypes for metadata/feature columns
+    cp_dtypes = {"Metadata_Field": "category", "Metadata_Well": "category"}
+    cp_dtypes.update({feature_col: np.float32 for feature_col in feature_cols})
 
     # load single-cell plate data using desired columns
-    cp_plate = pd.read_csv(cp_plate_path, usecols=cols_to_load, low_memory=True)
+    cp_plate = pd.read_csv(
+        cp_plate_path,
+        usecols=cols_to_load,
+        dtype=cp_dtypes,
+        low_memory=True,
+        chunksize=chunksize,
+    )
 
-    # add plate metadata
-    cp_plate["Metadata_Plate"] = plate
+    if chunksize is not None:
+        return (format_cp_image_data(cp_chunk, plate) for cp_chunk in cp_plate)
 
-    # convert well and field to one usable for merging
-    cp_plate["Metadata_Well"] = cp_plate["Metadata_Well"].apply(format_cp_well)
-    cp_plate["Metadata_Field"] = cp_plate["Metadata_Field"].apply(format_cp_site)
-    # rename field column to site (name used by DP)
-    cp_plate = cp_plate.rename(columns={"Metadata_Field": "Metadata_Site"})
+    return format_cp_image_data(cp_plate, plate)
 
-    return cp_plate
 
+def load_dp_index(dp_index_path: pathlib.Path) -> pd.DataFrame:
+    """
+    load DP index (one row of metadata for each image) so it only needs to be parsed once for all plates
 
-def full_loc_map(dp_coord: tuple, cp_image_data_locations: pd.Series) -> tuple:
+    Parameters
+    ----------
+    dp_index_path : pathlib.Path
+        path to index.csv file for DP project
+
+    Returns
+    -------
+    pd.DataFrame
+        DP index with metadata columns named as they are in DP output (Metadata_ prefix added)
+    """
+
+    dp_index = pd.read_csv(dp_index_path, dtype=str)
+    dp_index.columns = [
+        col if col.startswith("Metadata_") else f"Metadata_{col}"
+        for col in dp_index.columns
+    ]
+    # convert site to int (instead of string beginning with 0) to match DP output and CP formatted site
+    dp_index["Metadata_Site"] = dp_index["Metadata_Site"].astype(int).astype(str)
+
+    return dp_index
+
+
+def load_dp_image_data(
+    dp_image_features_path: pathlib.Path, dp_image_metadata: dict
+) -> pd.DataFrame:
     """
-    helper function for merge_CP_DP_batch_data
-    get cp_coord from cp_image_data_locations that is closest to dp_coord
+    load DP single-cell data for one image from its DP features file
 
     Parameters
     ----------
-    dp_coord : tuple
-        dp coord to find closest cp coord for
-    cp_image_data_locations : pd.Series
-        series of cp coords to get closest one from
+    dp_image_features_path : pathlib.Path
+        path to DP features file (.npz) for the image
+    dp_image_metadata : dict
+        metadata for the image (row of DP index)
 
     Returns
     -------
-    tuple
-        closest cp_coord to given dp_coord
-    """
-    return min(
-        cp_image_data_locations,
-        key=lambda cp_coord: math.hypot(
-            cp_coord[0] - dp_coord[0], cp_coord[1] - dp_coord[1]
-        ),
+    pd.DataFrame
+        single-cell data for the image with float32 features, ready for merging with CP output
+    """
+
+    with np.load(dp_image_features_path, allow_pickle=True) as dp_image_npz:
+        features = dp_image_npz["features"].astype(np.float32, copy=False)
+        locations = dp_image_npz["locations"]
+        npz_metadata = (
+            dp_image_npz["metadata"].item() if "metadata" in dp_image_npz.files else {}
+        )
+
+    # name features with the model used to extract them (as done by pycytominer, which uses efficientnet if the model is not saved)
+    model = npz_metadata.get("Model", npz_metadata.get("Metadata_Model"))
+    feature_prefix = "efficientnet" if model is None else str(model)
+    image_metadata = dict(dp_image_metadata)
+    if model is not None:
+        image_metadata["Metadata_Model"] = str(model)
+
+    dp_image_data = pd.DataFrame(
+        features,
+        columns=[f"{feature_prefix}_{index}" for index in range(features.shape[1])],
     )
+    for col, value in reversed(list(image_metadata.items())):
+        dp_image_data.insert(0, col, value)
+    dp_image_data.insert(0, "Location_Center_Y", locations[:, 1])
+    dp_image_data.insert(0, "Location_Center_X", locations[:, 0])
+
+    return dp_image_data
+
+
+def iter_dp_image_data(
+    dp_index: pd.DataFrame,
+    dp_features_path: pathlib.Path,
+    plate: str,
+    n_threads: int = 4,
+) -> Iterator[Tuple[Tuple[str, str], pd.DataFrame]]:
+    """
+    lazily load DP single-cell data for each image in a plate, in DP index order.
+    feature files are read ahead by a pool of threads so only a few images are in memory at once
+
+    Parameters
+    ----------
+    dp_index : pd.DataFrame
+        DP index loaded with load_dp_index
+    dp_features_path : pathlib.Path
+        path to DP features folder (outputs/efn_pretrained/features in DP project)
+    plate : str
+        name of plate that features are being loaded for
+    n_threads : int, optional
+        number of threads to read feature files with, by default 4
+
+    Yields
+    ------
+    Iterator[Tuple[Tuple[str, str], pd.DataFrame]]
+        (well, site) of the image and the single-cell data for that image.
+        images without a DP features file are skipped
+    """
+
+    plate_index = dp_index.loc[dp_index["Metadata_Plate"] == plate]
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        image_futures = deque()
+        for dp_image_metadata in plate_index.to_dict(orient="records"):
+            well = dp_image_metadata["Metadata_Well"]
+            site = dp_image_metadata["Metadata_Site"]
+            dp_image_features_path = pathlib.Path(
+                f"{dp_features_path}/{plate}/{well}/{site}.npz"
+            )
+            if not dp_image_features_path.is_file():
+                continue
+
+            image_futures.append(
+                (
+                    (well, site),
+                    executor.submit(
+                        load_dp_image_data, dp_image_features_path, dp_image_metadata
+                    ),
+                )
+            )
+            # only read a few images ahead of the image being yielded
+            if len(image_futures) > 2 * n_threads:
+                image, image_future = image_futures.popleft()
+                yield image, image_future.result()
+
+        while len(image_futures) > 0:
+            image, image_future = image_futures.popleft()
+            yield image, image_future.result()
+
+
+def get_closest_cp_indices(
+    dp_locations: np.ndarray,
+    cp_locations: np.ndarray,
+    one_to_one: bool = False,
+    max_distance: Optional[float] = None,
+) -> np.ndarray:
+    """
+    helper function for merge_CP_DP_image_data
+    get index of the cp location that is closest to each dp location
+
+    Parameters
+    ----------
+    dp_locations : np.ndarray
+        array of shape (n_dp_cells, 2) with the x and y coordinates of dp cells
+    cp_locations : np.ndarray
+        array of shape (n_cp_cells, 2) with the x and y coordinates of cp cells
+    one_to_one : bool, optional
+        whether each cp location can only be matched to one dp location, by default False.
+        if True, the assignment minimizing the total distance between matched cells is used
+    max_distance : Optional[float], optional
+        maximum distance allowed between matched locations, by default None (no maximum).
+        locations exactly max_distance apart are matched (the maximum is inclusive for both one_to_one options)
+
+    Returns
+    -------
+    np.ndarray
+        index of the closest cp location for each dp location (-1 if the dp location has no match)
+    """
+
+    closest_cp_indices = np.full(dp_locations.shape[0], -1, dtype=np.intp)
+    if dp_locations.shape[0] == 0 or cp_locations.shape[0] == 0:
+        return closest_cp_indices
+
+    upper_bound = np.inf if max_distance is None else max_distance
+
+    if one_to_one:
+        # find the assignment of dp cells to cp cells that minimizes the total distance between matched cells
+        distances = cdist(dp_locations, cp_locations)
+        dp_indices, cp_indices = linear_sum_assignment(distances)
+        within_distance = distances[dp_indices, cp_indices] <= upper_bound
+        closest_cp_indices[dp_indices[within_distance]] = cp_indices[within_distance]
+    else:
+        # query a kd-tree of cp locations for the nearest neighbor of each dp location
+        # (cKDTree only finds neighbors strictly within the upper bound,
+        # so the bound is raised to the next float to include neighbors exactly max_distance away)
+        distances, cp_indices = cKDTree(cp_locations).query(
+            dp_locations, k=1, distance_upper_bound=np.nextafter(upper_bound, np.inf)
+        )
+        # cKDTree marks locations without a neighbor within the upper bound with infinite distance
+        within_distance = np.isfinite(distances)
+        closest_cp_indices[within_distance] = cp_indices[within_distance]
+
+    return closest_cp_indices
 
 
 def merge_CP_DP_image_data(
     cp_image_data: pd.DataFrame,
     dp_image_data: pd.DataFrame,
     add_cell_uuid: bool = False,
+    one_to_one: bool = False,
+    max_distance: Optional[float] = None,
 ) -> pd.DataFrame:
     """
     merge CP and DP single-cell data from the same image (plate, well, site combination)
@@ -156,6 +382,11 @@ def merge_CP_DP_image_data(
         dp single-cell data from the image to merge cells from
     add_cell_uuid : bool, optional
         whether or not single-cell UUIDs should be added (useful for identifying a particular cell), by default False
+    one_to_one : bool, optional
+        whether each CP cell can only be merged with one DP cell, by default False
+    max_distance : Optional[float], optional
+        maximum distance (in pixels) between merged CP and DP cell locations, by default None (no maximum).
+        DP cells without a CP cell within this distance are not included in the merged data
 
     Returns
     -------
@@ -164,7 +395,7 @@ def merge_CP_DP_image_data(
 
     Raises
     ------
-    IndexError
+    CellCountMismatchError
         thrown if CP and DP data do not have the same number of cells
         (they must have the same number to merge cell data)
     """
@@ -184,7 +415,9 @@ def merge_CP_DP_image_data(
     # check batch data have same number of rows (cells)
     # if batch data have different number of cells, raise an error because they must not have close segmentations
     if cp_image_data.shape[0] != dp_image_data.shape[0]:
-        raise IndexError("Batch data have different number of rows (cells)!")
+        raise CellCountMismatchError(
+            "Batch data have different number of rows (cells)!"
+        )
 
     # get cp and dp column names
     cp_columns = cp_image_data.columns
@@ -204,30 +437,29 @@ def merge_CP_DP_image_data(
         columns={col: f"DP__{col}" for col in dp_columns}
     )
 
-    # create a location column with x and y coordinates as tuple
-    cp_image_data["Full_Location"] = list(
-        zip(
-            cp_image_data["Location_Center_X"],
-            cp_image_data["Location_Center_Y"],
-        )
-    )
-    dp_image_data["Full_Location"] = list(
-        zip(
-            dp_image_data["Location_Center_X"],
-            dp_image_data["Location_Center_Y"],
-        )
-    )
-
     # make location for dp match the closest cp location (distance minimized with hypotenuse)
-    dp_image_data["Full_Location"] = dp_image_data["Full_Location"].map(
-        lambda dp_coord: full_loc_map(dp_coord, cp_image_data["Full_Location"])
+    closest_cp_indices = get_closest_cp_indices(
+        dp_image_data[["Location_Center_X", "Location_Center_Y"]].to_numpy(),
+        cp_image_data[["Location_Center_X", "Location_Center_Y"]].to_numpy(),
+        one_to_one=one_to_one,
+        max_distance=max_distance,
     )
+    # pair each matched dp cell with its cp cell, keeping cp cell order (the order merging on location gives)
+    dp_indices = np.flatnonzero(closest_cp_indices >= 0)
+    dp_indices = dp_indices[np.argsort(closest_cp_indices[dp_indices], kind="stable")]
+    cp_indices = closest_cp_indices[dp_indices]
 
     # drop metadata columns from DP before merge
     dp_image_data = dp_image_data.drop(columns=metadata_columns)
 
-    # merge cp and dp data on location
-    merged_image_data = pd.merge(cp_image_data, dp_image_data, on="Full_Location")
+    # merge cp and dp data on matched locations
+    merged_image_data = pd.concat(
+        [
+            cp_image_data.iloc[cp_indices].reset_index(drop=True),
+            dp_image_data.iloc[dp_indices].reset_index(drop=True),
+        ],
+        axis=1,
+    )
 
     # rename reagent and platemap columns (important metadata)
     merged_image_data = merged_image_data.rename(
@@ -238,13 +470,14 @@ def merge_CP_DP_image_data(
     )
 
     # drop unecessary columns
+    # (DP__Metadata_Model is only in DP data if the model was saved in the DP features file)
     merged_image_data = merged_image_data.drop(
         columns=[
-            "Full_Location",
             "DP__Metadata_DNA",
             "DP__Metadata_Reagent_Replicate",
             "DP__Metadata_Model",
-        ]
+        ],
+        errors="ignore",
     )
 
     # drop NA and inf rows (DP sometimes is unable to extract features but only for around 10 out of 100,000 cells)
@@ -269,3 +502,510 @@ def merge_CP_DP_image_data(
 
     # return formatted merged data
     return merged_image_data[sorted_cols]
+
+
+def get_image_groups(plate_data: pd.DataFrame) -> dict:
+    """
+    get row positions of the single cells from each image (well, site combination) in plate data
+
+    Parameters
+    ----------
+    plate_data : pd.DataFrame
+        single-cell data from an entire plate
+
+    Returns
+    -------
+    dict
+        (well, site) tuple keys with an array of row positions in plate_data as values
+    """
+
+    # use string well and site so CP and DP images are identified the same way
+    image_metadata = pd.DataFrame(
+        {
+            "Metadata_Well": plate_data["Metadata_Well"].astype(str).to_numpy(),
+            "Metadata_Site": plate_data["Metadata_Site"].astype(str).to_numpy(),
+        }
+    )
+
+    return image_metadata.groupby(
+        ["Metadata_Well", "Metadata_Site"], sort=False
+    ).indices
+
+
+def merge_image_task(
+    cp_image_data: pd.DataFrame, dp_image_data: pd.DataFrame, merge_kwargs: dict
+) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
+    """
+    helper function for merge_CP_DP_plate_data
+    merge one image, returning the reason the image could not be merged instead of raising it
+    (only cell count mismatches are returned, any other error is raised)
+
+    Parameters
+    ----------
+    cp_image_data : pd.DataFrame
+        cp single-cell data from the image to merge cells from
+    dp_image_data : pd.DataFrame
+        dp single-cell data from the image to merge cells from
+    merge_kwargs : dict
+        keyword arguments passed to merge_CP_DP_image_data
+
+    Returns
+    -------
+    Tuple[Optional[pd.DataFrame], Optional[str]]
+        merged single-cell data for the image (None if it could not be merged),
+        reason the image could not be merged (None if it was merged)
+    """
+
+    try:
+        return (
+            merge_CP_DP_image_data(cp_image_data, dp_image_data, **merge_kwargs),
+            None,
+        )
+    except CellCountMismatchError as e:
+        return None, str(e)
+
+
+def iter_merged_images(
+    cp_plate_data: pd.DataFrame,
+    dp_image_batches: Iterable[Tuple[Tuple[str, str], pd.DataFrame]],
+    n_workers: int = 1,
+    memory_budget_gb: Optional[float] = None,
+    **merge_kwargs,
+) -> Iterator[Tuple[Tuple[str, str], Optional[pd.DataFrame], list]]:
+    """
+    merge CP single-cell data from a plate with batches of DP single-cell data from each image in that plate.
+    dp image batches are consumed lazily, so only the images being merged need to be in memory
+
+    Parameters
+    ----------
+    cp_plate_data : pd.DataFrame
+        cp single-cell data from the plate to merge cells from
+    dp_image_batches : Iterable[Tuple[Tuple[str, str], pd.DataFrame]]
+        (well, site) of each image with the dp single-cell data from that image
+    n_workers : int, optional
+        number of worker processes to merge images with, by default 1 (merge images in this process)
+    memory_budget_gb : Optional[float], optional
+        approximate memory (in GB) that images being merged by workers at the same time can use, by default None (no limit)
+    **merge_kwargs
+        keyword arguments passed to merge_CP_DP_image_data for each image
+
+    Yields
+    ------
+    Iterator[Tuple[Tuple[str, str], Optional[pd.DataFrame], list]]
+        (well, site) of the image,
+        merged single-cell data for the image (None if the image could not be merged),
+        report row for the image if it could not be merged (well, site, number of CP cells, number of DP cells, reason)
+    """
+
+    cp_image_groups = get_image_groups(cp_plate_data)
+    dp_images = set()
+
+    def image_tasks() -> Iterator[tuple]:
+        for image, dp_image_data in dp_image_batches:
+            dp_images.add(image)
+            cp_image_data = cp_plate_data.iloc[cp_image_groups.get(image, [])]
+            yield image, cp_image_data, dp_image_data
+
+    def image_task_bytes(image_task: tuple) -> float:
+        # merged image data is about as large as the image data
+        return 2 * (
+            image_task[1].memory_usage().sum() + image_task[2].memory_usage().sum()
+        )
+
+    def merge_image_task_batch(image_task_batch: List[tuple], pool=None) -> list:
+        # images that only have DP cells are reported without merging
+        batch_to_merge = [
+            (cp_image_data, dp_image_data, merge_kwargs)
+            for _, cp_image_data, dp_image_data in image_task_batch
+            if cp_image_data.shape[0] > 0
+        ]
+        if pool is None:
+            merged_batch = iter(
+                [merge_image_task(*image_task) for image_task in batch_to_merge]
+            )
+        else:
+            merged_batch = iter(pool.starmap(merge_image_task, batch_to_merge))
+
+        image_results = []
+        for (well, site), cp_image_data, dp_image_data in image_task_batch:
+            if cp_image_data.shape[0] > 0:
+                merged_image_data, unmerged_reason = next(merged_batch)
+            else:
+                merged_image_data, unmerged_reason = None, "image only in DP data"
+
+            unmerged_image = None
+            if merged_image_data is None:
+                unmerged_image = [
+                    well,
+                    site,
+                    cp_image_data.shape[0],
+                    dp_image_data.shape[0],
+                    unmerged_reason,
+                ]
+            image_results.append(((well, site), merged_image_data, unmerged_image))
+
+        return image_results
+
+    # merge images in batches that fit in the memory budget, keeping the image order for any number of workers
+    if n_workers > 1:
+        with mp.Pool(processes=n_workers) as pool:
+            for image_task_batch in task_utils.get_task_batches(
+                image_tasks(), image_task_bytes, memory_budget_gb
+            ):
+                yield from merge_image_task_batch(image_task_batch, pool)
+    else:
+        for image_task in image_tasks():
+            yield from merge_image_task_batch([image_task])
+
+    # report images that only have CP cells
+    for (well, site), cp_image_positions in cp_image_groups.items():
+        if (well, site) not in dp_images:
+            yield (well, site), None, [
+                well,
+                site,
+                len(cp_image_positions),
+                0,
+                "image only in CP data",
+            ]
+
+
+def merge_CP_DP_plate_data(
+    cp_plate_data: pd.DataFrame,
+    dp_plate_data: pd.DataFrame,
+    n_workers: int = 1,
+    memory_budget_gb: Optional[float] = None,
+    **merge_kwargs,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    merge CP and DP single-cell data from an entire plate, one image at a time
+    both plates are grouped by image once and only images found in both plates are merged
+
+    Parameters
+    ----------
+    cp_plate_data : pd.DataFrame
+        cp single-cell data from the plate to merge cells from
+    dp_plate_data : pd.DataFrame
+        dp single-cell data from the plate to merge cells from
+    n_workers : int, optional
+        number of worker processes to merge images with, by default 1 (merge images in this process)
+    memory_budget_gb : Optional[float], optional
+        approximate memory (in GB) that images being merged by workers at the same time can use, by default None (no limit)
+    **merge_kwargs
+        keyword arguments passed to merge_CP_DP_image_data for each image
+
+    Returns
+    -------
+    Tuple[pd.DataFrame, pd.DataFrame]
+        merged single-cell data for the entire plate (same output for any number of workers),
+        report of images that could not be merged (with the number of CP and DP cells and the reason)
+    """
+
+    dp_image_groups = get_image_groups(dp_plate_data)
+
+    # merge images in the order of DP wells, then DP sites (the order they first appear in)
+    well_order = {
+        well: rank
+        for rank, well in enumerate(dp_plate_data["Metadata_Well"].astype(str).unique())
+    }
+    site_order = {
+        site: rank
+        for rank, site in enumerate(dp_plate_data["Metadata_Site"].astype(str).unique())
+    }
+    dp_images = sorted(
+        dp_image_groups, key=lambda image: (well_order[image[0]], site_order[image[1]])
+    )
+    dp_image_batches = (
+        (image, dp_plate_data.iloc[dp_image_groups[image]]) for image in dp_images
+    )
+
+    merged_plate_single_cells = []
+    unmerged_images = []
+    for _, merged_image_data, unmerged_image in iter_merged_images(
+        cp_plate_data,
+        dp_image_batches,
+        n_workers=n_workers,
+        memory_budget_gb=memory_budget_gb,
+        **merge_kwargs,
+    ):
+        if merged_image_data is None:
+            unmerged_images.append(unmerged_image)
+        else:
+            merged_plate_single_cells.append(merged_image_data)
+
+    # combine all merged image data into one dataframe for the entire plate
+    if len(merged_plate_single_cells) > 0:
+        merged_plate_single_cells = pd.concat(merged_plate_single_cells).reset_index(
+            drop=True
+        )
+    else:
+        merged_plate_single_cells = pd.DataFrame()
+
+    return merged_plate_single_cells, get_unmerged_images_report(unmerged_images)
+
+
+def get_unmerged_images_report(unmerged_images: List[list]) -> pd.DataFrame:
+    """
+    get report of images that could not be merged
+
+    Parameters
+    ----------
+    unmerged_images : List[list]
+        report rows (well, site, number of CP cells, number of DP cells, reason) for each image that could not be merged
+
+    Returns
+    -------
+    pd.DataFrame
+        report of images that could not be merged
+    """
+
+    return pd.DataFrame(
+        unmerged_images,
+        columns=[
+            "Metadata_Well",
+            "Metadata_Site",
+            "CP_Cell_Count",
+            "DP_Cell_Count",
+            "Reason",
+        ],
+    )
+
+
+def merge_plate(
+    cp_output_path: pathlib.Path,
+    dp_index: pd.DataFrame,
+    dp_features_path: pathlib.Path,
+    merged_features_save_path: pathlib.Path,
+    n_workers: int = 1,
+    memory_budget_gb: Optional[float] = None,
+    n_threads: int = 4,
+    file_format: Literal["csv.gz", "parquet"] = "csv.gz",
+    **merge_kwargs,
+) -> pd.DataFrame:
+    """
+    load, merge, and save CP and DP single-cell data for one plate.
+    DP single-cell data is loaded and merged one image at a time and merged images are saved as they are merged,
+    so only the CP plate data and the images being merged need to be in memory
+
+    Parameters
+    ----------
+    cp_output_path : pathlib.Path
+        path to CP output folder for the plate (folder name is the plate name)
+    dp_index : pd.DataFrame
+        DP index loaded with load_dp_index
+    dp_features_path : pathlib.Path
+        path to DP features folder (outputs/efn_pretrained/features in DP project)
+    merged_features_save_path : pathlib.Path
+        path to folder to save merged single-cell data to
+    n_workers : int, optional
+        number of worker processes to merge images with, by default 1
+    memory_budget_gb : Optional[float], optional
+        approximate memory (in GB) that images being merged by workers at the same time can use, by default None (no limit)
+    n_threads : int, optional
+        number of threads to read DP feature files with, by default 4
+    file_format : Literal["csv.gz", "parquet"], optional
+        format to save merged single-cell data in, by default "csv.gz".
+        csv.gz saves a {plate}-merged-single-cell.csv.gz file,
+        parquet saves to a merged-single-cell.parquet dataset partitioned by plate and well
+    **merge_kwargs
+        keyword arguments passed to merge_CP_DP_image_data for each image
+
+    Returns
+    -------
+    pd.DataFrame
+        report of images that could not be merged
+    """
+
+    plate = cp_output_path.name
+
+    # load single cell dataframe for CP data
+    print(f"Loading CP features for plate {plate}...")
+    cp_plate_single_cells = load_cp_feature_data(cp_output_path, plate)
+
+    # merge each image in the plate (unique image for each plate, well, site combination) as its DP data is loaded
+    print(f"Merging features for plate {plate}...")
+    dp_image_batches = iter_dp_image_data(
+        dp_index, dp_features_path, plate, n_threads=n_threads
+    )
+
+    # save merged single-cell data one well at a time as images are merged
+    if file_format == "parquet":
+        merged_plate_single_cells_save_path = pathlib.Path(
+            f"{merged_features_save_path}/merged-single-cell.parquet"
+        )
+    else:
+        merged_plate_single_cells_save_path = pathlib.Path(
+            f"{merged_features_save_path}/{plate}-merged-single-cell.{file_format}"
+        )
+    unmerged_images = []
+    merged_well_single_cells = []
+    # well of the buffered merged images (merged images can have no cells, so the well is not read from them)
+    merged_well = None
+    saved_well_count = 0
+
+    def save_merged_well_single_cells():
+        plate_data_utils.save_plate_data(
+            pd.concat(merged_well_single_cells).reset_index(drop=True),
+            merged_plate_single_cells_save_path,
+            file_format=file_format,
+            append=saved_well_count > 0,
+        )
+
+    for (well, _), merged_image_data, unmerged_image in iter_merged_images(
+        cp_plate_single_cells,
+        dp_image_batches,
+        n_workers=n_workers,
+        memory_budget_gb=memory_budget_gb,
+        **merge_kwargs,
+    ):
+        if merged_image_data is None:
+            unmerged_images.append(unmerged_image)
+            continue
+
+        # save merged images from the previous well once images from a new well are merged
+        if len(merged_well_single_cells) > 0 and merged_well != well:
+            save_merged_well_single_cells()
+            saved_well_count += 1
+            merged_well_single_cells = []
+        merged_well = well
+        merged_well_single_cells.append(merged_image_data)
+
+    if len(merged_well_single_cells) > 0:
+        save_merged_well_single_cells()
+
+    return get_unmerged_images_report(unmerged_images)
+
+
+def merge_plate_task(
+    cp_output_path: pathlib.Path,
+    dp_index: pd.DataFrame,
+    dp_features_path: pathlib.Path,
+    merged_features_save_path: pathlib.Path,
+    merge_kwargs: dict,
+) -> pd.DataFrame:
+    """
+    helper function for merge_plates
+    merge one plate with keyword arguments passed as a dictionary (so the plate can be merged by a pool worker)
+
+    Parameters
+    ----------
+    cp_output_path : pathlib.Path
+        path to CP output folder for the plate
+    dp_index : pd.DataFrame
+        DP index loaded with load_dp_index
+    dp_features_path : pathlib.Path
+        path to DP features folder
+    merged_features_save_path : pathlib.Path
+        path to folder to save merged single-cell data to
+    merge_kwargs : dict
+        keyword arguments passed to merge_plate
+
+    Returns
+    -------
+    pd.DataFrame
+        report of images that could not be merged
+    """
+
+    return merge_plate(
+        cp_output_path,
+        dp_index,
+        dp_features_path,
+        merged_features_save_path,
+        **merge_kwargs,
+    )
+
+
+def merge_plates(
+    cp_output_paths: List[pathlib.Path],
+    dp_index_path: pathlib.Path,
+    dp_features_path: pathlib.Path,
+    merged_features_save_path: pathlib.Path,
+    n_workers: int = 1,
+    memory_budget_gb: Optional[float] = None,
+    plate_memory_gb: Optional[float] = None,
+    n_threads: int = 4,
+    file_format: Literal["csv.gz", "parquet"] = "csv.gz",
+    **merge_kwargs,
+) -> dict:
+    """
+    load, merge, and save CP and DP single-cell data for multiple plates with a pool of worker processes.
+    plates are merged at the same time when plate_memory_gb is given and more than one plate fits in the memory budget,
+    otherwise plates are merged one after another and the workers merge images within each plate.
+    saved merged data is the same for any number of workers
+
+    Parameters
+    ----------
+    cp_output_paths : List[pathlib.Path]
+        paths to CP output folders for each plate (folder names are the plate names)
+    dp_index_path : pathlib.Path
+        path to index.csv file for DP project (only loaded once for all plates)
+    dp_features_path : pathlib.Path
+        path to DP features folder (outputs/efn_pretrained/features in DP project)
+    merged_features_save_path : pathlib.Path
+        path to folder to save merged single-cell data to
+    n_workers : int, optional
+        number of worker processes to use, by default 1
+    memory_budget_gb : Optional[float], optional
+        approximate memory (in GB) that workers can use at the same time, by default None (no limit)
+    plate_memory_gb : Optional[float], optional
+        approximate peak memory (in GB) needed to merge one plate, by default None (plates are merged one after another)
+    n_threads : int, optional
+        number of threads to read DP feature files with for each plate, by default 4
+    file_format : Literal["csv.gz", "parquet"], optional
+        format to save merged single-cell data in, by default "csv.gz"
+    **merge_kwargs
+        keyword arguments passed to merge_CP_DP_image_data for each image
+
+    Returns
+    -------
+    dict
+        plate name keys with the report of images that could not be merged for that plate as values
+    """
+
+    dp_index = load_dp_index(dp_index_path)
+
+    # determine how many plates can be merged at the same time
+    n_plate_workers = 1
+    if plate_memory_gb is not None:
+        n_plate_workers = min(n_workers, len(cp_output_paths))
+        if memory_budget_gb is not None:
+            n_plate_workers = min(
+                n_plate_workers, max(int(memory_budget_gb // plate_memory_gb), 1)
+            )
+
+    if n_plate_workers > 1:
+        # each worker merges a whole plate, with images from that plate merged in the worker process
+        plate_tasks = [
+            (
+                cp_output_path,
+                dp_index,
+                dp_features_path,
+                merged_features_save_path,
+                dict(n_threads=n_threads, file_format=file_format, **merge_kwargs),
+            )
+            for cp_output_path in cp_output_paths
+        ]
+        with mp.Pool(processes=n_plate_workers) as pool:
+            plates_unmerged_images = pool.starmap(merge_plate_task, plate_tasks)
+    else:
+        # plates are merged one after another, with images from each plate merged by the workers
+        plates_unmerged_images = [
+            merge_plate(
+                cp_output_path,
+                dp_index,
+                dp_features_path,
+                merged_features_save_path,
+                n_workers=n_workers,
+                memory_budget_gb=memory_budget_gb,
+                n_threads=n_threads,
+                file_format=file_format,
+                **merge_kwargs,
+            )
+            for cp_output_path in cp_output_paths
+        ]
+
+    return {
+        cp_output_path.name: unmerged_images
+        for cp_output_path, unmerged_images in zip(
+            cp_output_paths, plates_unmerged_images
+        )
+    }
@@ -0,0 +1,152 @@
+import importlib
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+merge_utils = importlib.import_module("merge-utils")
+
+
+def get_dp_image_metadata() -> dict:
+    return {
+        "Metadata_Plate": "SQ00014610",
+        "Metadata_Well": "A1",
+        "Metadata_Site": "1",
+        "Metadata_Plate_Map_Name": "SQ00014610",
+        "Metadata_DNA": "SQ00014610/r01c01f01p01-ch5sk1fk1fl1.tiff",
+        "Metadata_Reagent": "EMPTY",
+        "Metadata_Reagent_Replicate": "1",
+    }
+
+
+def get_cp_image_data(locations: np.ndarray) -> pd.DataFrame:
+    cp_image_data = pd.DataFrame(
+        {
+            "Location_Center_X": locations[:, 0],
+            "Location_Center_Y": locations[:, 1],
+            "Metadata_Plate": "SQ00014610",
+            "Metadata_Well": "A1",
+            "Metadata_Site": "1",
+        }
+    )
+    cp_image_data["AreaShape_Area"] = np.arange(locations.shape[0], dtype=np.float32)
+
+    return cp_image_data
+
+
+def test_merge_dp_image_data_without_npz_metadata(tmp_path):
+    locations = np.array([[10.0, 20.0], [30.0, 40.0]])
+    features = np.arange(6, dtype=np.float64).reshape(2, 3)
+    dp_image_features_path = tmp_path / "1.npz"
+    np.savez(dp_image_features_path, features=features, locations=locations)
+
+    dp_image_data = merge_utils.load_dp_image_data(
+        dp_image_features_path, get_dp_image_metadata()
+    )
+
+    # features are named with the pycytominer default model name when the model is not saved
+    assert dp_image_data.columns[-3:].to_list() == [
+        "efficientnet_0",
+        "efficientnet_1",
+        "efficientnet_2",
+    ]
+    assert "Metadata_Model" not in dp_image_data.columns
+
+    merged_image_data = merge_utils.merge_CP_DP_image_data(
+        get_cp_image_data(locations), dp_image_data
+    )
+
+    assert merged_image_data.shape[0] == 2
+    assert "DP__efficientnet_0" in merged_image_data.columns
+    assert not any("Metadata_Model" in col for col in merged_image_data.columns)
+    np.testing.assert_array_equal(
+        merged_image_data[["DP__efficientnet_0", "DP__efficientnet_2"]].to_numpy(),
+        features[:, [0, 2]],
+    )
+
+
+def test_merge_dp_image_data_with_npz_metadata(tmp_path):
+    locations = np.array([[10.0, 20.0], [30.0, 40.0]])
+    features = np.ones((2, 3))
+    dp_image_features_path = tmp_path / "1.npz"
+    np.savez(
+        dp_image_features_path,
+        features=features,
+        locations=locations,
+        metadata={"Model": "efficientnet"},
+    )
+
+    dp_image_data = merge_utils.load_dp_image_data(
+        dp_image_features_path, get_dp_image_metadata()
+    )
+    assert (dp_image_data["Metadata_Model"] == "efficientnet").all()
+
+    merged_image_data = merge_utils.merge_CP_DP_image_data(
+        get_cp_image_data(locations), dp_image_data
+    )
+
+    assert merged_image_data.shape[0] == 2
+    assert "DP__efficientnet_0" in merged_image_data.columns
+    assert "DP__Metadata_Model" not in merged_image_data.columns
+
+
+@pytest.mark.parametrize("file_format", ["csv.gz", "parquet"])
+def test_merge_plate_with_image_without_matched_cells(
+    tmp_path, monkeypatch, file_format
+):
+    locations = np.array([[10.0, 20.0], [30.0, 40.0]])
+    cp_plate_data = pd.concat(
+        [
+            # first image of the plate has no CP cells near its DP cells
+            get_cp_image_data(locations + 1000).assign(Metadata_Well="A1"),
+            get_cp_image_data(locations).assign(Metadata_Well="B2"),
+        ],
+        ignore_index=True,
+    )
+
+    def iter_dp_image_data(*args, **kwargs):
+        for well_index, well in enumerate(["A1", "B2"]):
+            dp_image_features_path = tmp_path / f"{well}.npz"
+            np.savez(
+                dp_image_features_path,
+                features=np.full((2, 3), well_index, dtype=np.float64),
+                locations=locations,
+            )
+            yield (well, "1"), merge_utils.load_dp_image_data(
+                dp_image_features_path,
+                {**get_dp_image_metadata(), "Metadata_Well": well},
+            )
+
+    monkeypatch.setattr(
+        merge_utils, "load_cp_feature_data", lambda *args, **kwargs: cp_plate_data
+    )
+    monkeypatch.setattr(merge_utils, "iter_dp_image_data", iter_dp_image_data)
+
+    cp_output_path = tmp_path / "SQ00014610"
+    merged_features_save_path = tmp_path / "merged"
+    merged_features_save_path.mkdir()
+    unmerged_images = merge_utils.merge_plate(
+        cp_output_path,
+        pd.DataFrame(),
+        tmp_path,
+        merged_features_save_path,
+        file_format=file_format,
+        max_distance=5,
+    )
+
+    assert unmerged_images.shape[0] == 0
+    if file_format == "parquet":
+        merged_plate_data = pd.read_parquet(
+            merged_features_save_path / "merged-single-cell.parquet"
+        )
+    else:
+        merged_plate_data = pd.read_csv(
+            merged_features_save_path / "SQ00014610-merged-single-cell.csv.gz"
+        )
+    # only cells from the image with matched cells are saved
+    assert merged_plate_data.shape[0] == 2
+    assert (merged_plate_data["Metadata_Well"].astype(str) == "B2").all()
+    assert (merged_plate_data["DP__efficientnet_0"] == 1).all()
@@ -4,12 +4,12 @@
 # ### Import Libraries
 # 
 
-# In[1]:
+# In[ ]:
 
 
 import pathlib
-import joblib
 import importlib
+import sys
 
 import pandas as pd
 import numpy as np
@@ -18,11 +18,14 @@ from pycytominer.cyto_utils import DeepProfiler_processing
 
 normalization_utils = importlib.import_module("normalization-utils")
 
+sys.path.append("../../utils")
+import plate_data_utils
+
 
 # ### Set Load/Save Paths
 # 
 
-# In[2]:
+# In[ ]:
 
 
 # paths to load merged features,index, and annotations from
@@ -44,76 +47,167 @@ normalized_merged_features_save_path.mkdir(parents=True, exist_ok=True)
 scaler_save_dir = pathlib.Path("normalization-scalers/")
 scaler_save_dir.mkdir(parents=True, exist_ok=True)
 
+# format merged features are saved in and to save normalized features in ("csv.gz" or "parquet")
+# parquet data is saved to one dataset partitioned by plate and well, so only needed plates/columns are loaded by later modules
+file_format = "csv.gz"
+
+# number of cells to load and normalize at a time (None loads and normalizes each whole plate at once)
+# plates are read twice when normalized in chunks (once to fit the scaler and once to apply it), but only one chunk is kept in memory
+chunksize = 200000
+
+# normalization method ("standard" for mean/standard deviation or "robust" for median/MAD)
+# robust statistics are approximated with a streaming quantile sketch, so plates can still be normalized in chunks
+normalization_method = "standard"
+
+# whether to save normalized plates (normalization scalers are always saved as npz files with center/scale arrays)
+# normalized plates do not need to be saved if features are normalized while they are loaded in 4.classify-single-cell-phenotypes
+save_normalized_plates = True
+
 
 # ### Normalize merged single-cell data
 # 
 
-# In[3]:
+# In[ ]:
 
 
 # iterate through each merged plate, find normalization scaler from negative control cells, and apply this scaler to all cells
-for merged_single_cell_plate_path in merged_features_save_path.iterdir():
-    # get only plate name from merged features file name
-    plate = merged_single_cell_plate_path.name.split("-")[0]
-    print(f"Normalizing plate {plate}...")
-
-    # load in one row to create datatypes dictionary for faster loading
-    first_row_data = pd.read_csv(
-        merged_single_cell_plate_path, compression="gzip", nrows=1
+if file_format == "parquet":
+    merged_single_cell_data_path = pathlib.Path(
+        f"{merged_features_save_path}/merged-single-cell.parquet"
     )
-    metadata_cols = [col for col in first_row_data.columns if "P__" not in col]
-    feature_cols = [col for col in first_row_data.columns if "P__" in col]
-
-    # specify datatypes for metadata/feature columns
-    metadata_dtypes = {metadata_col: str for metadata_col in metadata_cols}
-    feature_dtypes = {feature_col: np.float32 for feature_col in feature_cols}
-    # combine both dictionaries
-    plate_dtypes = {**metadata_dtypes, **feature_dtypes}
-
-    # load plate single-cell data
-    print(f"Loading single-cell data...")
-    plate_merged_single_cells = pd.read_csv(
-        merged_single_cell_plate_path,
-        compression="gzip",
-        dtype=plate_dtypes,
-        low_memory=True,
+else:
+    merged_single_cell_data_path = merged_features_save_path
+for plate in plate_data_utils.get_plate_names(
+    merged_single_cell_data_path, file_format
+):
+    print(f"Normalizing plate {plate}...")
+    if file_format == "parquet":
+        merged_single_cell_plate_path = merged_single_cell_data_path
+    else:
+        merged_single_cell_plate_path = pathlib.Path(
+            f"{merged_features_save_path}/{plate}-merged-single-cell.csv.gz"
+        )
+
+    # load plate columns with their positions and dtypes (saved with merged features)
+    plate_schema = plate_data_utils.load_plate_schema(
+        merged_single_cell_plate_path, plate, file_format
     )
+    feature_cols = [
+        plate_schema["columns"][index] for index in plate_schema["feature_indices"]
+    ]
 
     # create per-plate normalization scaler from the normalization population
     print(f"Deriving normalization scaler...")
-    plate_scaler = normalization_utils.get_normalization_scaler(
-        plate_merged_single_cells
-    )
-    # save normalization scaler
-    scaler_save_path = pathlib.Path(
-        f"{scaler_save_dir}/{plate}-merged-normalization-scaler.joblib"
+    if chunksize is None:
+        # load plate single-cell data
+        plate_merged_single_cells = [
+            normalization_utils.load_plate_data(
+                merged_single_cell_plate_path,
+                plate,
+                file_format,
+                plate_schema=plate_schema,
+            )
+        ]
+        plate_scaler = normalization_utils.get_normalization_scaler(
+            plate_merged_single_cells[0],
+            normalization_method,
+            feature_cols=feature_cols,
+        )
+    else:
+        plate_scaler = normalization_utils.get_normalization_scaler(
+            normalization_utils.load_plate_data(
+                merged_single_cell_plate_path,
+                plate,
+                file_format,
+                chunksize=chunksize,
+                plate_schema=plate_schema,
+            ),
+            normalization_method,
+            feature_cols=feature_cols,
+        )
+    # save normalization scaler as center/scale arrays
+    if normalization_method == "robust":
+        scaler_save_path = pathlib.Path(
+            f"{scaler_save_dir}/{plate}-merged-robust-normalization-scaler.npz"
+        )
+    else:
+        scaler_save_path = pathlib.Path(
+            f"{scaler_save_dir}/{plate}-merged-normalization-scaler.npz"
+        )
+    normalization_utils.save_normalization_params(
+        plate_scaler, feature_cols, scaler_save_path
     )
-    joblib.dump(plate_scaler, scaler_save_path)
 
-    # apply scaler to all single cell feature data
-    print(f"Applying normalization scaler...")
-    # get normalized feature data
-    feature_cols = [
-        col for col in plate_merged_single_cells.columns.to_list() if "P__" in col
-    ]
-    features = plate_merged_single_cells[feature_cols].values
-    features = plate_scaler.transform(features)
-    features = pd.DataFrame(features, columns=feature_cols)
-    # get metadata for all single cells
-    metadata_cols = [
-        col for col in plate_merged_single_cells.columns.to_list() if "P__" not in col
-    ]
-    metadata = plate_merged_single_cells[metadata_cols]
+    if not save_normalized_plates:
+        continue
+
+    # apply scaler to all single cell feature data and compress and save normalized single-cell data
+    print(f"Applying normalization scaler and saving normalized features...")
+    if chunksize is not None:
+        plate_merged_single_cells = normalization_utils.load_plate_data(
+            merged_single_cell_plate_path,
+            plate,
+            file_format,
+            chunksize=chunksize,
+            plate_schema=plate_schema,
+        )
+    if file_format == "parquet":
+        normalized_merged_plate_single_cells_save_path = pathlib.Path(
+            f"{normalized_merged_features_save_path}/normalized-merged-single-cell.parquet"
+        )
+    else:
+        normalized_merged_plate_single_cells_save_path = pathlib.Path(
+            f"{normalized_merged_features_save_path}/{plate}-normalized-merged-single-cell.csv.gz"
+        )
+    normalization_utils.normalize_plate_data(
+        plate_merged_single_cells,
+        plate_scaler,
+        normalized_merged_plate_single_cells_save_path,
+        file_format,
+        feature_cols=feature_cols,
+    )
 
-    # combine metadata and normalized features for all single cells (replace other single cell dataframe to not keep two dfs in memory)
-    plate_merged_single_cells = pd.concat([metadata, features], axis=1)
 
-    # compress and save merged single-cell data
-    print(f"Saving normalized features...")
-    normalized_merged_plate_single_cells_save_path = pathlib.Path(
-        f"{normalized_merged_features_save_path}/{plate}-normalized-merged-single-cell.csv.gz"
-    )
-    plate_merged_single_cells.to_csv(
-        normalized_merged_plate_single_cells_save_path, compression="gzip", index=False
-    )
+# ### Convert normalization scalers saved as joblib files
+# 
+# Normalization scalers were first saved as pickled sklearn objects (`{plate}-merged-normalization-scaler.joblib` in [normalization-scalers/](normalization-scalers/)).
+# These scalers were fit without feature names, so they are converted to npz files with the feature columns of each merged plate (in the order the scalers were fit with).
+
+# In[ ]:
+
+
+# whether to convert joblib scalers of merged plates without an npz scaler to npz files (so they can be used when features are normalized while they are loaded)
+convert_joblib_scalers = False
+
+if convert_joblib_scalers:
+    for plate in plate_data_utils.get_plate_names(
+        merged_single_cell_data_path, file_format
+    ):
+        joblib_scaler_path = pathlib.Path(
+            f"{scaler_save_dir}/{plate}-merged-normalization-scaler.joblib"
+        )
+        scaler_save_path = pathlib.Path(
+            f"{scaler_save_dir}/{plate}-merged-normalization-scaler.npz"
+        )
+        if not joblib_scaler_path.is_file() or scaler_save_path.is_file():
+            continue
+
+        print(f"Converting normalization scaler for plate {plate}...")
+        if file_format == "parquet":
+            merged_single_cell_plate_path = merged_single_cell_data_path
+        else:
+            merged_single_cell_plate_path = pathlib.Path(
+                f"{merged_features_save_path}/{plate}-merged-single-cell.csv.gz"
+            )
+        plate_schema = plate_data_utils.load_plate_schema(
+            merged_single_cell_plate_path, plate, file_format
+        )
+        normalization_utils.convert_normalization_scaler(
+            joblib_scaler_path,
+            [
+                plate_schema["columns"][index]
+                for index in plate_schema["feature_indices"]
+            ],
+            scaler_save_path,
+        )
 
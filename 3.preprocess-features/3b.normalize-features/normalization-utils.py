@@ -1,35 +1,471 @@
 from importlib.resources import path
+import copy
+import pathlib
+import sys
+from typing import Iterable, Iterator, List, Literal, Optional, Union
 
+import joblib
+import numpy as np
 import pandas as pd
-from sklearn.preprocessing import StandardScaler
+import pyarrow.dataset as ds
+from sklearn.preprocessing import RobustScaler, StandardScaler
 
+# plate data format shared by all modules (defined in utils/plate_data_utils.py at the root of the repository)
+sys.path.append(f"{pathlib.Path(__file__).resolve().parents[2]}/utils")
+import plate_data_utils
 
-def get_normalization_scaler(plate_merged_single_cells: pd.DataFrame) -> StandardScaler:
+
+class QuantileSketch:
     """
-    get normalization scaler from single cell dataframe
+    mergeable streaming quantile sketch (KLL sketch from Karnin, Lang, and Liberty, 2016) for each column of a feature matrix.
+    items are kept in levels where each item at level h represents 2**h values.
+    when a level holds more items than its capacity, it is sorted and every other item (starting from a random offset) is moved up a level.
+    all columns are compacted together, so each level is one (n_items, n_features) array.
+    NaN values are sorted as the largest values and are ignored by quantile queries.
+
+    with k=200, the rank of a quantile estimate is within about 1.5% of the number of values seen (empirically, for up to 10 million values),
+    and error shrinks roughly as 1/k. MAD estimates have up to twice this rank error.
 
     Parameters
     ----------
-    plate_merged_single_cells : pd.DataFrame
-        dataframe with all single cells from plate
+    k : int, optional
+        capacity of the top level (larger k is more accurate but uses more memory), by default 200
+    seed : Optional[int], optional
+        seed for random compaction offsets, by default None
+    """
+
+    def __init__(self, k: int = 200, seed: Optional[int] = None):
+        self.k = k
+        self.n = 0
+        self.levels = []
+        self._rng = np.random.default_rng(seed)
+
+    def _get_level_capacity(self, level: int) -> int:
+        # lower levels have geometrically smaller capacities
+        return max(2, int(np.ceil(self.k * (2 / 3) ** (len(self.levels) - level - 1))))
+
+    def _compress(self) -> None:
+        level = 0
+        while level < len(self.levels):
+            if self.levels[level].shape[0] > self._get_level_capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(self.levels[level][:0])
+                level_items = np.sort(self.levels[level], axis=0)
+                # an odd item out stays on its level
+                n_compacted = level_items.shape[0] - level_items.shape[0] % 2
+                offset = self._rng.integers(2)
+                self.levels[level + 1] = np.concatenate(
+                    [self.levels[level + 1], level_items[offset:n_compacted:2]]
+                )
+                self.levels[level] = level_items[n_compacted:]
+            level += 1
+
+    def update(self, values: np.ndarray) -> "QuantileSketch":
+        """
+        add values to sketch
+
+        Parameters
+        ----------
+        values : np.ndarray
+            2D array of values (rows are cells, columns are features)
+
+        Returns
+        -------
+        QuantileSketch
+            updated sketch
+        """
+
+        values = np.asarray(values, dtype=np.float64)
+        if len(self.levels) == 0:
+            self.levels.append(values[:0])
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.n += values.shape[0]
+        self._compress()
+
+        return self
+
+    def merge(self, other: "QuantileSketch") -> "QuantileSketch":
+        """
+        add values summarized by another sketch (of the same features) to sketch
+
+        Parameters
+        ----------
+        other : QuantileSketch
+            sketch to merge into this sketch
+
+        Returns
+        -------
+        QuantileSketch
+            merged sketch
+        """
+
+        for level, other_level_items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(other_level_items)
+            else:
+                self.levels[level] = np.concatenate(
+                    [self.levels[level], other_level_items]
+                )
+        self.n += other.n
+        self._compress()
+
+        return self
+
+    def _get_weighted_quantile(self, items: np.ndarray, q: float) -> np.ndarray:
+        weights = np.concatenate(
+            [
+                np.full(len(level_items), 2.0**level)
+                for level, level_items in enumerate(self.levels)
+            ]
+        )
+        # sort items (NaN last) and give NaN items no weight
+        sort_order = np.argsort(items, axis=0)
+        sorted_items = np.take_along_axis(items, sort_order, axis=0)
+        sorted_weights = np.where(np.isnan(sorted_items), 0, weights[sort_order])
+        cumulative_weights = np.cumsum(sorted_weights, axis=0)
+        # find first item with at least a q fraction of total weight at or below it
+        quantile_index = (cumulative_weights < q * cumulative_weights[-1]).sum(axis=0)
+        quantile_index = np.minimum(quantile_index, items.shape[0] - 1)
+        quantiles = sorted_items[quantile_index, np.arange(items.shape[1])]
+
+        return np.where(cumulative_weights[-1] > 0, quantiles, np.nan)
+
+    def quantile(self, q: float) -> np.ndarray:
+        """
+        get approximate quantile of each feature
+
+        Parameters
+        ----------
+        q : float
+            quantile to get, between 0 and 1
+
+        Returns
+        -------
+        np.ndarray
+            approximate quantile of each feature (NaN for features without values)
+        """
+
+        return self._get_weighted_quantile(np.concatenate(self.levels), q)
+
+    def median_abs_deviation(self) -> np.ndarray:
+        """
+        get approximate median absolute deviation (MAD) of each feature.
+        the distribution of absolute deviations from the median is estimated from the same sketch items,
+        so MAD can be found in one pass over the data
+
+        Returns
+        -------
+        np.ndarray
+            approximate MAD of each feature (NaN for features without values)
+        """
+
+        items = np.concatenate(self.levels)
+        return self._get_weighted_quantile(np.abs(items - self.quantile(0.5)), 0.5)
+
+
+def get_normalization_scaler(
+    plate_merged_single_cells: Union[pd.DataFrame, Iterable[pd.DataFrame]],
+    method: Literal["standard", "robust"] = "standard",
+    sketch_k: int = 200,
+    feature_cols: Optional[List[str]] = None,
+) -> Union[StandardScaler, RobustScaler]:
+    """
+    get normalization scaler from single cell dataframe.
+    if an iterable of single cell dataframes is given (a plate loaded in chunks),
+    the scaler is fit one chunk at a time so only one chunk needs to be in memory
+
+    Parameters
+    ----------
+    plate_merged_single_cells : Union[pd.DataFrame, Iterable[pd.DataFrame]]
+        dataframe with all single cells from plate or iterable of dataframes with chunks of single cells from plate
+    method : Literal["standard", "robust"], optional
+        normalization method, by default "standard".
+        standard removes the mean and scales to unit variance,
+        robust removes the median and scales by the median absolute deviation (MAD) scaled to the standard deviation of a normal distribution.
+        robust statistics are approximated with a QuantileSketch
+    sketch_k : int, optional
+        accuracy parameter of QuantileSketch used for robust normalization, by default 200
+    feature_cols : Optional[List[str]], optional
+        feature columns to fit scaler with (from plate schema), by default None (columns with P__ in their name)
 
     Returns
     -------
-    StandardScaler
+    Union[StandardScaler, RobustScaler]
         normalization scaler for merged feature cells
+
+    Raises
+    ------
+    ValueError
+        thrown if there are no negative control cells in plate
     """
 
-    # find all cells that have had no reagent applied
-    negative_control_single_cells = plate_merged_single_cells.loc[
-        plate_merged_single_cells["Metadata_Reagent"] == "no-reagent"
-    ]
-    # get features for these negative control cells
-    feature_cols = [
-        col for col in negative_control_single_cells.columns.to_list() if "P__" in col
-    ]
-    negative_control_feature_data = negative_control_single_cells[feature_cols].values
-    # fit normalization scaler
+    if isinstance(plate_merged_single_cells, pd.DataFrame):
+        plate_merged_single_cells = [plate_merged_single_cells]
+
     plate_scaler = StandardScaler()
-    plate_scaler.fit(negative_control_feature_data)
+    plate_sketch = QuantileSketch(k=sketch_k, seed=0)
+    for plate_merged_single_cells_chunk in plate_merged_single_cells:
+        # find all cells that have had no reagent applied
+        negative_control_single_cells = plate_merged_single_cells_chunk.loc[
+            plate_merged_single_cells_chunk["Metadata_Reagent"] == "no-reagent"
+        ]
+        if negative_control_single_cells.shape[0] == 0:
+            continue
+        # get features for these negative control cells
+        if feature_cols is None:
+            feature_cols = [
+                col
+                for col in negative_control_single_cells.columns.to_list()
+                if "P__" in col
+            ]
+        negative_control_feature_data = negative_control_single_cells[
+            feature_cols
+        ].values
+        # update normalization scaler (or sketch) with control cells from chunk
+        if method == "robust":
+            plate_sketch.update(negative_control_feature_data)
+        else:
+            plate_scaler.partial_fit(negative_control_feature_data)
+
+    if method == "robust":
+        if plate_sketch.n == 0:
+            raise ValueError(
+                "No negative control cells found to fit normalization scaler!"
+            )
+        return get_robust_scaler(plate_sketch)
+
+    if not hasattr(plate_scaler, "n_samples_seen_"):
+        raise ValueError("No negative control cells found to fit normalization scaler!")
 
     return plate_scaler
+
+
+def get_robust_scaler(sketch: QuantileSketch) -> RobustScaler:
+    """
+    get robust normalization scaler from a quantile sketch of negative control features (which can be merged from sketches of plate chunks).
+    features are centered by median and scaled by MAD * 1.4826 (so scale matches standard deviation for normally distributed features)
+
+    Parameters
+    ----------
+    sketch : QuantileSketch
+        sketch of negative control features
+
+    Returns
+    -------
+    RobustScaler
+        fitted robust normalization scaler
+    """
+
+    # scale MAD to standard deviation of a normal distribution (as with scipy.stats.median_abs_deviation scale="normal")
+    scale = sketch.median_abs_deviation() * 1.482602218505602
+    # do not scale constant features (as with sklearn scalers)
+    scale[(scale == 0) | np.isnan(scale)] = 1.0
+
+    robust_scaler = RobustScaler()
+    robust_scaler.center_ = sketch.quantile(0.5)
+    robust_scaler.scale_ = scale
+    robust_scaler.n_features_in_ = len(scale)
+
+    return robust_scaler
+
+
+def save_normalization_params(
+    plate_scaler: Union[StandardScaler, RobustScaler],
+    feature_names: List[str],
+    save_path: pathlib.Path,
+) -> None:
+    """
+    save normalization scaler as compact arrays (npz file with center, scale, and feature_names arrays) instead of a pickled sklearn object.
+    normalized features are (features - center) / scale, so they can be derived while merged features are loaded
+
+    Parameters
+    ----------
+    plate_scaler : Union[StandardScaler, RobustScaler]
+        normalization scaler derived with get_normalization_scaler
+    feature_names : List[str]
+        names of features the scaler was fit with (in order)
+    save_path : pathlib.Path
+        path to npz file to save normalization parameters to
+    """
+
+    if isinstance(plate_scaler, RobustScaler):
+        center = plate_scaler.center_
+    else:
+        center = plate_scaler.mean_
+
+    np.savez(
+        save_path,
+        center=center.astype(np.float32),
+        scale=plate_scaler.scale_.astype(np.float32),
+        feature_names=np.array(feature_names, dtype=str),
+    )
+
+
+def convert_normalization_scaler(
+    scaler_path: pathlib.Path, feature_names: List[str], save_path: pathlib.Path
+) -> None:
+    """
+    convert a normalization scaler saved as a pickled sklearn object ({plate}-merged-normalization-scaler.joblib) to compact arrays (see save_normalization_params).
+    pickled scalers were fit on the feature columns of the merged plate (in column order) without feature names, so feature names must be given in this order
+
+    Parameters
+    ----------
+    scaler_path : pathlib.Path
+        path to joblib file with pickled normalization scaler
+    feature_names : List[str]
+        names of features the scaler was fit with (feature columns of the merged plate, in order)
+    save_path : pathlib.Path
+        path to npz file to save normalization parameters to
+
+    Raises
+    ------
+    ValueError
+        thrown if the scaler was not fit with the same number of features as there are feature names
+    """
+
+    plate_scaler = joblib.load(scaler_path)
+    if plate_scaler.n_features_in_ != len(feature_names):
+        raise ValueError(
+            f"{scaler_path} was fit with {plate_scaler.n_features_in_} features, but {len(feature_names)} feature names were given!"
+        )
+
+    save_normalization_params(plate_scaler, feature_names, save_path)
+
+
+def normalize_plate_data(
+    plate_merged_single_cells: Iterable[pd.DataFrame],
+    plate_scaler: Union[StandardScaler, RobustScaler],
+    save_path: pathlib.Path,
+    file_format: Literal["csv.gz", "parquet"] = "csv.gz",
+    feature_cols: Optional[List[str]] = None,
+) -> None:
+    """
+    apply normalization scaler to chunks of single cells from plate and save each normalized chunk as it is derived.
+    features are normalized as float32 in place, so only one chunk needs to be in memory
+
+    Parameters
+    ----------
+    plate_merged_single_cells : Iterable[pd.DataFrame]
+        dataframes with chunks of single cells from plate (can be a list with one dataframe for the whole plate)
+    plate_scaler : Union[StandardScaler, RobustScaler]
+        normalization scaler derived with get_normalization_scaler
+    save_path : pathlib.Path
+        path to save normalized single cells to, passed to save_plate_data
+    file_format : Literal["csv.gz", "parquet"], optional
+        format to save normalized single cells in, by default "csv.gz"
+    feature_cols : Optional[List[str]], optional
+        feature columns to normalize (from plate schema), by default None (columns with P__ in their name)
+    """
+
+    # normalize features in place with a shallow copy of the scaler that does not copy features
+    inplace_scaler = copy.copy(plate_scaler).set_params(copy=False)
+
+    for chunk_index, plate_merged_single_cells_chunk in enumerate(
+        plate_merged_single_cells
+    ):
+        if feature_cols is None:
+            feature_cols = [
+                col for col in plate_merged_single_cells_chunk.columns if "P__" in col
+            ]
+        plate_merged_single_cells_chunk[feature_cols] = inplace_scaler.transform(
+            plate_merged_single_cells_chunk[feature_cols].to_numpy(dtype=np.float32)
+        )
+        plate_data_utils.save_plate_data(
+            plate_merged_single_cells_chunk,
+            save_path,
+            file_format,
+            append=chunk_index > 0,
+        )
+
+
+def load_plate_data(
+    plate_data_path: pathlib.Path,
+    plate: str,
+    file_format: Literal["csv.gz", "parquet"] = "csv.gz",
+    columns: Optional[List[str]] = None,
+    chunksize: Optional[int] = None,
+    plate_schema: Optional[dict] = None,
+) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+    """
+    load single-cell data for one plate with features as float32.
+    only the plate's partition and the columns needed are read from a parquet dataset
+
+    Parameters
+    ----------
+    plate_data_path : pathlib.Path
+        path to compressed csv file with plate data or to parquet dataset folder
+    plate : str
+        name of plate to load data for
+    file_format : Literal["csv.gz", "parquet"], optional
+        format plate data is saved in, by default "csv.gz"
+    columns : Optional[List[str]], optional
+        columns to load, by default None (load all columns)
+    chunksize : Optional[int], optional
+        number of cells to load at a time, by default None (load whole plate)
+    plate_schema : Optional[dict], optional
+        schema of plate data (from load_plate_schema) to get compressed csv columns and dtypes from,
+        by default None (columns are read from the csv header)
+
+    Returns
+    -------
+    Union[pd.DataFrame, Iterator[pd.DataFrame]]
+        single-cell data for plate, or iterator of single-cell data chunks if chunksize is given
+    """
+
+    if file_format == "parquet":
+        plate_dataset = ds.dataset(
+            plate_data_path,
+            format="parquet",
+            partitioning=plate_data_utils.PLATE_DATA_PARTITIONING,
+        )
+        if columns is None:
+            # partition columns are placed after location columns (where they are in merged data)
+            location_cols = [
+                col for col in plate_dataset.schema.names if col.startswith("Location_")
+            ]
+            columns = (
+                location_cols
+                + ["Metadata_Plate", "Metadata_Well"]
+                + [
+                    col
+                    for col in plate_dataset.schema.names
+                    if col not in location_cols
+                    and col not in ["Metadata_Plate", "Metadata_Well"]
+                ]
+            )
+        if chunksize is not None:
+            return (
+                plate_batch.to_pandas()
+                for plate_batch in plate_dataset.to_batches(
+                    columns=columns,
+                    filter=ds.field("Metadata_Plate") == plate,
+                    batch_size=chunksize,
+                )
+            )
+        return plate_dataset.to_table(
+            columns=columns, filter=ds.field("Metadata_Plate") == plate
+        ).to_pandas()
+
+    if plate_schema is not None:
+        # columns and datatypes are saved with plate data
+        if columns is None:
+            columns = plate_schema["columns"]
+        plate_dtypes = dict(zip(plate_schema["columns"], plate_schema["dtypes"]))
+        plate_dtypes = {col: plate_dtypes[col] for col in columns}
+    else:
+        # load in one row to create datatypes dictionary for faster loading
+        plate_data_cols = pd.read_csv(plate_data_path, nrows=0).columns
+        if columns is None:
+            columns = plate_data_cols.to_list()
+        plate_dtypes = {col: np.float32 if "P__" in col else str for col in columns}
+
+    plate_data = pd.read_csv(
+        plate_data_path,
+        usecols=columns,
+        dtype=plate_dtypes,
+        low_memory=True,
+        chunksize=chunksize,
+    )
+    if chunksize is not None:
+        return (plate_data_chunk[columns] for plate_data_chunk in plate_data)
+    return plate_data[columns]
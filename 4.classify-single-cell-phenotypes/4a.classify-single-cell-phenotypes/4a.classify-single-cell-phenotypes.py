@@ -9,25 +9,26 @@
 # ### Import libraries
 # 
 
-# In[1]:
+# In[ ]:
 
 
 import pathlib
 import sys
-import gc # import garbace collector interface to reduce memory usage in this notebook
 
-import joblib
 import pandas as pd
 import numpy as np
 
 sys.path.append("../")
 import classification_utils
 
+sys.path.append("../../utils")
+import plate_data_utils
+
 
 # ### Define hard drive path and classifications output path
 # 
 
-# In[2]:
+# In[ ]:
 
 
 # external paths to normalized data and classifications
@@ -40,13 +41,40 @@ classifications_save_path = pathlib.Path(
 )
 classifications_save_path.mkdir(exist_ok=True, parents=True)
 
-# path to multi-class and single-class models
-multi_class_models_dir = pathlib.Path(
-    "phenotypic_profiling_model/2.train_model/models/multi_class_models"
+# format normalized data is saved in and to save classifications in ("csv.gz" or "parquet")
+# parquet data is saved to one dataset per model partitioned by plate and well
+file_format = "csv.gz"
+
+# whether to save classifications from all models to one parquet dataset partitioned by plate and well (regardless of file_format)
+# metadata is only saved once and each model's probabilities are saved in columns named {model_name}/{phenotypic_class}
+combine_model_classifications = False
+# data type to save combined classifications as ("float32" or "uint16", which quantizes probabilities to multiples of 1/65535)
+classifications_dtype = "float32"
+
+# whether to normalize merged features as they are loaded (with the normalization scalers saved in 3.preprocess-features)
+# instead of loading normalized plates, so normalized plates do not need to be saved
+normalize_on_load = False
+merged_plates_path = pathlib.Path(
+    "/media/roshankern/63af2010-c376-459e-a56e-576b170133b6/data/cell-health-nuc-merged"
 )
-single_class_models_dir = pathlib.Path(
-    "phenotypic_profiling_model/2.train_model/models/single_class_models"
+normalization_scalers_dir = pathlib.Path(
+    "../../3.preprocess-features/3b.normalize-features/normalization-scalers"
 )
+# name of normalization scaler files (merged-robust-normalization-scaler for robust normalization)
+normalization_scaler_name = "merged-normalization-scaler"
+
+# number of cells to load and classify at a time (None loads and classifies each whole plate at once)
+# classifications are saved as each chunk is classified, so memory use does not depend on plate size
+chunksize = 100000
+
+# number of threads that score cells with models of different feature types at the same time
+# and memory budget (in GB) for the feature types scored at the same time (None for no budget)
+# classifications are the same for any number of workers
+n_workers = 4
+memory_budget_gb = 16
+
+# path to multi-class and single-class models
+models_dir = pathlib.Path("phenotypic_profiling_model/2.train_model/models")
 
 
 # ### Derive and save phenotypic class probabilities
@@ -55,95 +83,102 @@ single_class_models_dir = pathlib.Path(
 # In[ ]:
 
 
-# iterate through plates so each plate data only needs to be loaded once
-for normalized_plate_path in normalized_plates_path.iterdir():
+# load all models once, each model is named by the folder its classifications are saved to
+# models are only loaded again if their files change
+print("Loading multi-class and single-class models...")
+model_registry = classification_utils.ModelRegistry(models_dir)
+models = model_registry.get_models()
 
-    # get plate name from normalized data path
-    plate = normalized_plate_path.name.split("-")[0]
-    print(f"Getting phenotypic_class_probabilities for plate {plate}...")
+# models with the same feature type score cells together
+inference_engine = classification_utils.BatchedInferenceEngine(
+    models, n_workers=n_workers, memory_budget_gb=memory_budget_gb
+)
 
-    # determine what type columns are
-    all_cols = pd.read_csv(normalized_plate_path, nrows=1).columns.to_list()
-    feature_cols = [col for col in all_cols if "P__" in col]
-    metadata_cols = [col for col in all_cols if "P__" not in col]
+# iterate through plates so each plate data only needs to be loaded once
+if normalize_on_load:
+    plates_path = merged_plates_path
+    plate_data_name = "merged-single-cell"
+else:
+    plates_path = normalized_plates_path
+    plate_data_name = "normalized-merged-single-cell"
+if file_format == "parquet":
+    plates_data_path = pathlib.Path(f"{plates_path}/{plate_data_name}.parquet")
+else:
+    plates_data_path = plates_path
+for plate in plate_data_utils.get_plate_names(plates_data_path, file_format):
 
-    print("Loading plate feature data...")
-    # load features
-    col_types = {col: np.float32 for col in feature_cols}
-    plate_features = pd.read_csv(
-        normalized_plate_path, usecols=feature_cols,
-    )
-    
-    # load metadata
-    print("Loading plate metadata...")
-    col_types = {col: str for col in metadata_cols}
-    plate_metadata = pd.read_csv(
-        normalized_plate_path, usecols=metadata_cols,
+    print(f"Getting phenotypic_class_probabilities for plate {plate}...")
+    if file_format == "parquet":
+        plate_path = plates_data_path
+    else:
+        plate_path = pathlib.Path(f"{plates_path}/{plate}-{plate_data_name}.csv.gz")
+    if normalize_on_load:
+        normalization_params_path = pathlib.Path(
+            f"{normalization_scalers_dir}/{plate}-{normalization_scaler_name}.npz"
+        )
+    else:
+        normalization_params_path = None
+
+    # determine what type columns are from the schema saved with the plate data
+    plate_schema = plate_data_utils.load_plate_schema(plate_path, plate, file_format)
+    metadata_cols = np.delete(
+        plate_schema["columns"], plate_schema["feature_indices"]
+    ).tolist()
+
+    # load plate metadata and features (as float32) in chunks, with columns in schema order
+    print("Loading and classifying plate single-cell data...")
+    plate_chunks = classification_utils.load_plate_data(
+        plate_path,
+        plate,
+        plate_schema["columns"],
+        file_format,
+        normalization_params_path,
+        chunksize=chunksize,
     )
+    if chunksize is None:
+        plate_chunks = [plate_chunks]
 
-    print("Getting multi-class model classifications...")
-    for model_path in sorted(multi_class_models_dir.iterdir()):
-        
-        print(model_path)
-
-        # load current model
-        model = joblib.load(model_path)
-
-        # get information about the current model
-        model_type = model_path.name.split("__")[0]
-        feature_type = model_path.name.split("__")[1].replace(".joblib", "")
+    for chunk_index, plate_chunk in enumerate(plate_chunks):
+        plate_metadata = plate_chunk[metadata_cols]
 
-        # get phenotypic class probabilities for the given plate features
-        plate_probas = classification_utils.get_probas_dataframe(
-            plate_features, model, feature_type
+        # get phenotypic class probabilities for the given plate features from every model
+        plate_models_probas = inference_engine.get_probas_dataframes(
+            plate_chunk, plate_schema
         )
 
-        # save plate probas with metadata
-        save_dir_name = model_path.name.replace(".joblib", "")
-        model_plate_probas_save_path = pathlib.Path(
-            f"{classifications_save_path}/multi_class_models/{save_dir_name}/{plate}__cell_classifications.csv.gz"
-        )
-        model_plate_probas_save_path.parent.mkdir(exist_ok=True, parents=True)
-        pd.concat([plate_metadata, plate_probas], axis=1).to_csv(
-            model_plate_probas_save_path, compression="gzip"
-        )
-        
-        # perform garbage collection to save memory
-        del plate_probas
-        gc.collect()
-    
-    print("Getting single-class model classifications...")
-    for phenotypic_class_models_path in sorted(single_class_models_dir.iterdir()):
-        for model_path in sorted(phenotypic_class_models_path.iterdir()):
-
-            # load current model
-            model = joblib.load(model_path)
-
-            # get information about the current model
-            phenotypic_class = phenotypic_class_models_path.name.split("_")[0]
-            model_type = model_path.name.split("__")[0]
-            feature_type = model_path.name.split("__")[1].replace(".joblib", "")
-
-            # get phenotypic class probabilities for the given plate features
-            plate_probas = classification_utils.get_probas_dataframe(
-                plate_features, model, feature_type
-            )
-
-            # save plate probas with metadata
-            model_plate_probas_save_path = pathlib.Path(
-                f"{classifications_save_path}/single_class_models/{phenotypic_class}_models/{model_type}__{feature_type}/{plate}__cell_classifications.csv.gz"
-            )
-            model_plate_probas_save_path.parent.mkdir(exist_ok=True, parents=True)
-            pd.concat([plate_metadata, plate_probas], axis=1).to_csv(
-                model_plate_probas_save_path, compression="gzip", index=False
+        if combine_model_classifications:
+            # save plate probas from all models with metadata saved once
+            plate_data_utils.save_plate_data(
+                plate_data_utils.get_combined_classifications(
+                    plate_metadata, plate_models_probas, classifications_dtype
+                ),
+                pathlib.Path(f"{classifications_save_path}/cell_classifications.parquet"),
+                "parquet",
+                append=chunk_index > 0,
             )
-            
-            # perform garbage collection to save memory
-            del plate_probas
-            gc.collect()
-            
-    # perform garbage collection to save memory    
-    del plate_features
-    del plate_metadata
-    gc.collect()
+        else:
+            for model_name, plate_probas in plate_models_probas.items():
+
+                # save plate probas with metadata
+                model_probas_save_dir = pathlib.Path(
+                    f"{classifications_save_path}/{model_name}"
+                )
+                model_probas_save_dir.mkdir(exist_ok=True, parents=True)
+                if file_format == "parquet":
+                    model_plate_probas_save_path = pathlib.Path(
+                        f"{model_probas_save_dir}/cell_classifications.parquet"
+                    )
+                else:
+                    model_plate_probas_save_path = pathlib.Path(
+                        f"{model_probas_save_dir}/{plate}__cell_classifications.csv.gz"
+                    )
+                # align probas with chunk index (multi-class model classifications are saved with their index)
+                plate_probas.index = plate_metadata.index
+                plate_data_utils.save_plate_data(
+                    pd.concat([plate_metadata, plate_probas], axis=1),
+                    model_plate_probas_save_path,
+                    file_format,
+                    append=chunk_index > 0,
+                    index=model_name.startswith("multi_class_models"),
+                )
 
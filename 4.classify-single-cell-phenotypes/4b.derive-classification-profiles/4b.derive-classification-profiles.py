@@ -9,7 +9,7 @@
 # ### Import Libraries
 # 
 
-# In[1]:
+# In[ ]:
 
 
 import pathlib
@@ -20,20 +20,41 @@ import pandas as pd
 sys.path.append("../")
 import classification_utils
 
+sys.path.append("../../utils")
+import plate_data_utils
+
 
 # ### Load Cell Health Profile Labels
 # 
 
-# In[2]:
+# In[ ]:
 
 
 cell_health_hash = (
     "30ea5de393eb9cfc10b575582aa9f0f857b44c59"  # hash from Jan 26th, 2022
 )
-cell_health_labels_link = f"https://raw.github.com/broadinstitute/cell-health/{cell_health_hash}/1.generate-profiles/data/consensus/cell_health_median.tsv.gz"
 
-cell_health_labels = pd.read_csv(cell_health_labels_link, compression="gzip", sep="\t")
-cell_health_labels
+# label profiles are downloaded from the cell health repository once and cached as parquet (keyed by cell_health_hash)
+# set cell_health_labels_source to a local copy of cell_health_median.tsv.gz (or a local URL) to create the cache offline
+cell_health_labels_cache_dir = pathlib.Path("cell_health_labels")
+cell_health_labels_source = None
+# sha256 checksum cell_health_median.tsv.gz must have, checked when it is fetched and when it is loaded from the cache
+# (None to not verify it, the checksum of the file is then printed so it can be set here)
+cell_health_labels_sha256 = None
+
+# load labels only when run as the main script
+# (worker processes started with spawn, the default on macOS and Windows, import this script without running it)
+if __name__ == "__main__":
+    cell_health_labels = classification_utils.load_cell_health_labels(
+        cell_health_hash,
+        cell_health_labels_cache_dir,
+        cell_health_labels_source,
+        cell_health_labels_sha256,
+    )
+    if cell_health_labels_sha256 is None:
+        print(
+            f"Cell Health labels not verified, set cell_health_labels_sha256 to {cell_health_labels.attrs['source_sha256']} to verify them"
+        )
 
 
 # ### Create Classification Profiles
@@ -51,7 +72,7 @@ cell_line_plates = {
 }
 
 
-# In[4]:
+# In[ ]:
 
 
 # paths to set (data is loaded from/saved to external hard drive)
@@ -73,65 +94,134 @@ SCM_classifications = pathlib.Path(
 )
 classification_profiles_save_dir.mkdir(exist_ok=True, parents=True)
 
-# derive multi class model classification profiles
-print("Deriving multi class model classification profiles")
+# format single-cell classifications are saved in ("csv.gz" or "parquet")
+file_format = "csv.gz"
+# whether classifications from all models are combined in one dataset (combine_model_classifications in 4a)
+combine_model_classifications = False
 
-# multi class models storage format is base_dir/model_type__feature_type.joblib
-for model_classifications_dir in MCM_classifications.iterdir():
+# number of cells to load at a time when averaging classifications (None loads one whole plate at a time)
+# classifications are averaged with running sums for each perturbation, so only one chunk is kept in memory
+chunksize = 100000
 
-    # get information about the current model's classifications we are looking at
-    model_type = model_classifications_dir.name.split("__")[0]
-    feature_type = model_classifications_dir.name.split("__")[1]
+# folder to cache sums and counts of class probabilities for each perturbation in each plate (None to not cache them)
+# aggregates are only derived again if plate classifications change, so profiles are assembled from cached aggregates
+# when cell_line_plates changes or models are added
+aggregates_cache_dir = pathlib.Path(
+    f"{base_dir_path}/cell-health-plate-classification-aggregates"
+)
 
-    print(
-        f"Deriving classification profiles for {model_classifications_dir.name}"
+# number of processes that derive classification profiles of different models at the same time
+n_workers = 8
+
+# derive classification profiles only when run as the main script
+# (worker processes started with spawn, the default on macOS and Windows, import this script without running it)
+if __name__ == "__main__":
+    # collect classification profiles to derive, each with a name, path to save profiles to, and create_classification_profiles arguments
+    profile_tasks = []
+    if combine_model_classifications:
+        combined_classifications_path = pathlib.Path(
+            f"{cell_health_plate_classifications}/cell_classifications.parquet"
+        )
+        # models are named by the folder their classifications are saved to when not combined
+        # (multi_class_models/model_type__feature_type or single_class_models/specific_phenotypic_class_models/model_type__feature_type)
+        for model_name in plate_data_utils.get_classification_model_names(
+            combined_classifications_path
+        ):
+            model_class_type, model_dir_name = model_name.split("/", 1)
+            if model_class_type == "single_class_models":
+                phenotypic_class = model_dir_name.split("/")[0].split("_")[0]
+                model_dir_name = f"{phenotypic_class}/{model_dir_name.split('/')[1]}"
+            classification_profiles_save_path = pathlib.Path(
+                f"{classification_profiles_save_dir}/{model_class_type}/{model_dir_name}__classification_profiles.tsv"
+            )
+            # derive classification profiles from only this model's classifications
+            profile_tasks.append(
+                (
+                    model_name,
+                    classification_profiles_save_path,
+                    dict(
+                        plate_classifications_dir=cell_health_plate_classifications,
+                        cell_line_plates=cell_line_plates,
+                        model_name=model_name,
+                        chunksize=chunksize,
+                        aggregates_cache_dir=aggregates_cache_dir,
+                    ),
+                )
+            )
+    else:
+        # multi class models storage format is base_dir/model_type__feature_type.joblib
+        for model_classifications_dir in MCM_classifications.iterdir():
+            classification_profiles_save_path = pathlib.Path(
+                f"{classification_profiles_save_dir}/multi_class_models/{model_classifications_dir.name}__classification_profiles.tsv"
+            )
+            profile_tasks.append(
+                (
+                    f"multi_class_models/{model_classifications_dir.name}",
+                    classification_profiles_save_path,
+                    dict(
+                        plate_classifications_dir=model_classifications_dir,
+                        cell_line_plates=cell_line_plates,
+                        file_format=file_format,
+                        chunksize=chunksize,
+                        aggregates_cache_dir=aggregates_cache_dir,
+                    ),
+                )
+            )
+
+        # single class models storage format is base_dir/specific_phenotypic_class/model_type__feature_type.joblib
+        for phenotypic_class_dir in SCM_classifications.iterdir():
+            for model_classifications_dir in phenotypic_class_dir.iterdir():
+                phenotypic_class = phenotypic_class_dir.name.split("_")[0]
+                classification_profiles_save_path = pathlib.Path(
+                    f"{classification_profiles_save_dir}/single_class_models/{phenotypic_class}/{model_classifications_dir.name}__classification_profiles.tsv"
+                )
+                profile_tasks.append(
+                    (
+                        f"single_class_models/{phenotypic_class_dir.name}/{model_classifications_dir.name}",
+                        classification_profiles_save_path,
+                        dict(
+                            plate_classifications_dir=model_classifications_dir,
+                            cell_line_plates=cell_line_plates,
+                            file_format=file_format,
+                            chunksize=chunksize,
+                            aggregates_cache_dir=aggregates_cache_dir,
+                        ),
+                    )
+                )
+
+    # derive and save classification profiles of each model (with the time each model takes)
+    print(f"Deriving classification profiles for {len(profile_tasks)} models")
+    classification_utils.derive_classification_profiles(profile_tasks, n_workers)
+
+
+# ### Correlate Classification Profiles with Cell Health Labels
+
+# In[ ]:
+
+
+# number of label permutations used to derive correlation p-values (0 to not derive p-values)
+n_permutations = 1000
+# whether to also correlate classification profiles of each cell line separately
+correlate_by_cell_line = True
+
+# correlate classification profiles only when run as the main script
+# (worker processes started with spawn, the default on macOS and Windows, import this script without running it)
+if __name__ == "__main__":
+    # correlate classes of all models with cell health labels at once
+    classification_profiles = {
+        task_name: pd.read_csv(classification_profiles_save_path, sep="\t")
+        for task_name, classification_profiles_save_path, _ in profile_tasks
+    }
+    correlation_engine = classification_utils.ProfileCorrelationEngine(
+        cell_health_labels, n_permutations=n_permutations
     )
-
-    # derive classification profiles
-    classification_profiles = classification_utils.create_classification_profiles(
-        model_classifications_dir, cell_line_plates
+    classification_profile_correlations = correlation_engine.get_correlations(
+        classification_profiles, by_cell_line=correlate_by_cell_line
     )
 
-    # save classification profiles
-    # save plate probas with metadata
-    classification_profiles_save_path = pathlib.Path(
-        f"{classification_profiles_save_dir}/multi_class_models/{model_classifications_dir.name}__classification_profiles.tsv"
-    )
-    classification_profiles_save_path.parent.mkdir(exist_ok=True, parents=True)
-    classification_profiles.to_csv(
-        classification_profiles_save_path, sep="\t", index=False
+    classification_profile_correlations.to_csv(
+        f"{classification_profiles_save_dir}/classification_profile_correlations.tsv",
+        sep="\t",
+        index=False,
     )
 
-# derive single class model classification profiles
-print("Deriving single class model classification profiles")
-
-# single class models storage format is base_dir/specific_phenotypic_class/model_type__feature_type.joblib
-for phenotypic_class_dir in SCM_classifications.iterdir():
-    print(f"Deriving classification profiles for {phenotypic_class_dir.name} models")
-    for model_classifications_dir in phenotypic_class_dir.iterdir():
-
-        # get information about the current model
-        phenotypic_class = phenotypic_class_dir.name.split("_")[0]
-        model_type = model_classifications_dir.name.split("__")[0]
-        feature_type = model_classifications_dir.name.split("__")[1].replace(
-            ".joblib", ""
-        )
-
-        print(
-            f"Deriving classification profiles for {model_type} model with {feature_type} features"
-        )
-
-        # derive classification profiles
-        classification_profiles = classification_utils.create_classification_profiles(
-            model_classifications_dir, cell_line_plates
-        )
-
-        # save classification profiles
-        classification_profiles_save_path = pathlib.Path(
-            f"{classification_profiles_save_dir}/single_class_models/{phenotypic_class}/{model_classifications_dir.name}__classification_profiles.tsv"
-        )
-        classification_profiles_save_path.parent.mkdir(exist_ok=True, parents=True)
-        classification_profiles.to_csv(
-            classification_profiles_save_path, sep="\t", index=False
-        )
-
@@ -2,17 +2,80 @@
 utils for classifying cells from Cell Health Data
 """
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import multiprocessing as mp
 import pathlib
-from typing import Literal
+import sys
+import time
+import urllib.request
+import uuid
+from typing import Any, Dict, Iterator, List, Literal, Optional, Tuple, Union
 
+import joblib
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from scipy.special import expit, softmax
+from scipy.stats import rankdata
 from sklearn.linear_model import LogisticRegression
 
+# plate data format and task batching shared by all modules (defined in utils/ at the root of the repository)
+sys.path.append(f"{pathlib.Path(__file__).resolve().parents[1]}/utils")
+import plate_data_utils
+import task_utils
+
+# cell health consensus label profiles at a commit of the cell health repository
+CELL_HEALTH_LABELS_URL = "https://raw.github.com/broadinstitute/cell-health/{cell_health_hash}/1.generate-profiles/data/consensus/cell_health_median.tsv.gz"
+
+
+def get_feature_cols(
+    all_cols: List[str],
+    feature_type: Literal[
+        "CP", "DP", "CP_and_DP", "CP_areashape_only", "CP_zernike_only"
+    ],
+) -> List[str]:
+    """
+    Get feature columns used by models trained with a feature type
+
+    Parameters
+    ----------
+    all_cols : List[str]
+        all columns of plate features
+    feature_type : str
+        type of features to use for classification.
+        CP, DP, CP_and_DP, CP_areashape_only, CP_zernike_only
+
+    Returns
+    -------
+    List[str]
+        feature columns for feature type
+    """
+
+    # determine which feature columns should be loaded depending on feature type
+    if "CP" in feature_type:
+        feature_cols = [col for col in all_cols if "CP__" in col]
+        if "zernike_only" in feature_type:
+            feature_cols = [col for col in feature_cols if "Zernike" in col]
+        elif "areashape_only" in feature_type:
+            feature_cols = [col for col in feature_cols if "AreaShape" in col]
+        elif "_and_DP" in feature_type:
+            feature_cols = [col for col in all_cols if "P__" in col]
+    elif "DP" in feature_type:
+        feature_cols = [col for col in all_cols if "DP__" in col]
+
+    return feature_cols
+
 
 def get_probas_dataframe(
     plate_features: pd.DataFrame,
     model: LogisticRegression,
     feature_type: Literal["CP", "DP", "CP_and_DP", "CP_areashape_only", "CP_zernike_only"],
+    plate_schema: Optional[dict] = None,
 ) -> pd.DataFrame:
     """
     Get probabilities for plate features from a phenotypic classification model
@@ -26,29 +89,24 @@ def get_probas_dataframe(
     feature_type : str
         type of features to use for classification.
         CP, DP, CP_and_DP, CP_areashape_only, CP_zernike_only
+    plate_schema : Optional[dict], optional
+        schema of plate data (from load_plate_schema) with feature type column positions,
+        by default None (feature columns are found by name). plate features must have the schema's columns if given
 
     Returns
     -------
     pd.DataFrame
         dataframe with single-cell probabilities for classes from given model
     """
-    
-    all_cols = plate_features.columns.to_list()
-
-    # determine which feature columns should be loaded depending on feature type
-    if "CP" in feature_type:
-        feature_cols = [col for col in all_cols if "CP__" in col]
-        if "zernike_only" in feature_type:
-            feature_cols = [col for col in feature_cols if "Zernike" in col]
-        elif "areashape_only" in feature_type:
-            feature_cols = [col for col in feature_cols if "AreaShape" in col]
-        elif "_and_DP" in feature_type:
-            feature_cols = [col for col in all_cols if "P__" in col]
-    elif  "DP" in feature_type:
-        feature_cols = [col for col in all_cols if "DP__" in col]
 
     # load these particular features and get the values
-    single_cell_features = plate_features[feature_cols].values
+    if plate_schema is not None:
+        single_cell_features = plate_features.iloc[
+            :, plate_schema["feature_type_indices"][feature_type]
+        ].values
+    else:
+        feature_cols = get_feature_cols(plate_features.columns.to_list(), feature_type)
+        single_cell_features = plate_features[feature_cols].values
 
     # get and return the predicted probabilities
     probas_dataframe = pd.DataFrame(
@@ -59,12 +117,698 @@ def get_probas_dataframe(
     return probas_dataframe
 
 
+class ModelRegistry:
+    """
+    Load phenotypic classification models (saved in phenotypic_profiling_model/2.train_model/models) once.
+    Loaded models are kept in a least recently used cache keyed by model path and modification time,
+    so a model is only loaded again if its file changes (or it was evicted from the cache).
+
+    Parameters
+    ----------
+    models_dir : pathlib.Path
+        path to models folder with multi_class_models and single_class_models folders
+    max_models : Optional[int], optional
+        maximum number of models to keep loaded, by default None (all models are kept loaded)
+    """
+
+    def __init__(self, models_dir: pathlib.Path, max_models: Optional[int] = None):
+        self.models_dir = pathlib.Path(models_dir)
+        self.max_models = max_models
+        self._models_cache = OrderedDict()
+
+    def get_model_paths(self) -> List[pathlib.Path]:
+        """
+        Get paths to multi-class models and single-class models (in that order)
+
+        Returns
+        -------
+        List[pathlib.Path]
+            paths to model files
+        """
+
+        # multi class models storage format is models_dir/multi_class_models/model_type__feature_type.joblib
+        model_paths = sorted(
+            pathlib.Path(f"{self.models_dir}/multi_class_models").iterdir()
+        )
+        # single class models storage format is models_dir/single_class_models/specific_phenotypic_class_models/model_type__feature_type.joblib
+        for phenotypic_class_models_path in sorted(
+            pathlib.Path(f"{self.models_dir}/single_class_models").iterdir()
+        ):
+            model_paths.extend(sorted(phenotypic_class_models_path.iterdir()))
+
+        return model_paths
+
+    @staticmethod
+    def get_model_info(model_path: pathlib.Path) -> Dict[str, Optional[str]]:
+        """
+        Get information about a model from its path
+
+        Parameters
+        ----------
+        model_path : pathlib.Path
+            path to model file
+
+        Returns
+        -------
+        Dict[str, Optional[str]]
+            model_type, feature_type, phenotypic_class (None for multi-class models),
+            and model_name (the folder the model's classifications are saved to)
+        """
+
+        model_path = pathlib.Path(model_path)
+        model_type = model_path.name.split("__")[0]
+        feature_type = model_path.name.split("__")[1].replace(".joblib", "")
+
+        if model_path.parent.parent.name == "single_class_models":
+            phenotypic_class = model_path.parent.name.split("_")[0]
+            model_name = f"single_class_models/{phenotypic_class}_models/{model_type}__{feature_type}"
+        else:
+            phenotypic_class = None
+            model_name = f"multi_class_models/{model_path.name.replace('.joblib', '')}"
+
+        return {
+            "model_type": model_type,
+            "feature_type": feature_type,
+            "phenotypic_class": phenotypic_class,
+            "model_name": model_name,
+        }
+
+    def load_model(self, model_path: pathlib.Path) -> Any:
+        """
+        Load a model, or get it from the cache if its file has not changed since it was loaded
+
+        Parameters
+        ----------
+        model_path : pathlib.Path
+            path to model file
+
+        Returns
+        -------
+        Any
+            loaded model
+        """
+
+        model_path = pathlib.Path(model_path).resolve()
+        cache_key = (model_path, model_path.stat().st_mtime_ns)
+        if cache_key in self._models_cache:
+            self._models_cache.move_to_end(cache_key)
+            return self._models_cache[cache_key]
+
+        # remove model loaded from an older version of the file
+        for stale_key in [key for key in self._models_cache if key[0] == model_path]:
+            del self._models_cache[stale_key]
+
+        model = joblib.load(model_path)
+        self._models_cache[cache_key] = model
+        if self.max_models is not None and len(self._models_cache) > self.max_models:
+            self._models_cache.popitem(last=False)
+
+        return model
+
+    def get_models(self) -> Dict[str, Tuple[Any, str]]:
+        """
+        Get all models with their feature types (as used by BatchedInferenceEngine)
+
+        Returns
+        -------
+        Dict[str, Tuple[Any, str]]
+            model names (the folders their classifications are saved to), each with a (model, feature_type) tuple
+        """
+
+        models = {}
+        for model_path in self.get_model_paths():
+            model_info = self.get_model_info(model_path)
+            models[model_info["model_name"]] = (
+                self.load_model(model_path),
+                model_info["feature_type"],
+            )
+
+        return models
+
+
+class BatchedInferenceEngine:
+    """
+    Get probabilities for plate features from many phenotypic classification models at once.
+    Models are grouped by feature type, and the coefficients of logistic regression models with the same feature type are stacked,
+    so each group of models scores cells with one matrix multiplication.
+    Scores are split back into per-model probabilities computed as LogisticRegression.predict_proba does
+    (one-vs-rest or multinomial). Other models use their own predict_proba.
+    Feature types can be scored in parallel by a thread pool, with every worker reading features from one feature matrix.
+
+    Parameters
+    ----------
+    models : Dict[str, Tuple[Any, str]]
+        model names, each with a (model, feature_type) tuple
+    n_workers : int, optional
+        number of threads that score feature types at the same time, by default 1 (feature types are scored one after another).
+        probabilities are the same for any number of workers
+    memory_budget_gb : Optional[float], optional
+        memory budget (in GB) for feature types scored at the same time, by default None (no budget).
+        feature types are scored in batches estimated to fit in the budget (a feature type larger than the budget is scored by itself)
+    """
+
+    def __init__(
+        self,
+        models: Dict[str, Tuple[Any, str]],
+        n_workers: int = 1,
+        memory_budget_gb: Optional[float] = None,
+    ):
+        self.models = models
+        self.n_workers = n_workers
+        self.memory_budget_gb = memory_budget_gb
+
+        # group models by feature type
+        self.feature_type_models = {}
+        for model_name, (model, feature_type) in models.items():
+            self.feature_type_models.setdefault(feature_type, []).append(model_name)
+
+        # stack logistic regression coefficients and intercepts of each feature type
+        self.feature_type_coefs = {}
+        for feature_type, model_names in self.feature_type_models.items():
+            lr_model_names = [
+                model_name
+                for model_name in model_names
+                if isinstance(models[model_name][0], LogisticRegression)
+            ]
+            if len(lr_model_names) == 0:
+                continue
+            coefs = np.concatenate(
+                [models[model_name][0].coef_ for model_name in lr_model_names]
+            )
+            intercepts = np.concatenate(
+                [
+                    np.broadcast_to(
+                        models[model_name][0].intercept_,
+                        models[model_name][0].coef_.shape[0],
+                    )
+                    for model_name in lr_model_names
+                ]
+            )
+            # score columns of each model
+            score_col_stops = np.cumsum(
+                [models[model_name][0].coef_.shape[0] for model_name in lr_model_names]
+            )
+            self.feature_type_coefs[feature_type] = (
+                lr_model_names,
+                coefs.T,
+                intercepts,
+                score_col_stops,
+            )
+
+    @staticmethod
+    def _get_lr_probas(model: LogisticRegression, scores: np.ndarray) -> np.ndarray:
+        # follow LogisticRegression.predict_proba (one-vs-rest for binary models unless multinomial was set)
+        multi_class = getattr(model, "multi_class", "auto")
+        if multi_class in ["ovr", "warn"] or (
+            multi_class not in ["multinomial"]
+            and (model.classes_.size <= 2 or model.solver == "liblinear")
+        ):
+            probas = expit(scores)
+            if probas.shape[1] == 1:
+                return np.hstack([1 - probas, probas])
+            return probas / probas.sum(axis=1).reshape((probas.shape[0], -1))
+
+        if scores.shape[1] == 1:
+            scores = np.hstack([-scores, scores])
+        return softmax(scores, axis=1)
+
+    def _get_feature_type_probas(
+        self, feature_type: str, feature_matrix: np.ndarray, feature_indices: np.ndarray
+    ) -> Dict[str, pd.DataFrame]:
+        # only index features if feature type does not use all of them (indexing copies features)
+        if np.array_equal(feature_indices, np.arange(feature_matrix.shape[1])):
+            single_cell_features = feature_matrix
+        else:
+            single_cell_features = feature_matrix[:, feature_indices]
+
+        probas_dataframes = {}
+        if feature_type in self.feature_type_coefs:
+            (
+                lr_model_names,
+                coefs,
+                intercepts,
+                score_col_stops,
+            ) = self.feature_type_coefs[feature_type]
+            # score cells with all logistic regression models of feature type at once
+            scores = single_cell_features @ coefs + intercepts
+            for model_name, model_scores in zip(
+                lr_model_names, np.split(scores, score_col_stops[:-1], axis=1)
+            ):
+                model = self.models[model_name][0]
+                probas_dataframes[model_name] = pd.DataFrame(
+                    self._get_lr_probas(model, model_scores),
+                    columns=model.classes_,
+                )
+
+        for model_name in self.feature_type_models[feature_type]:
+            if model_name not in probas_dataframes:
+                model = self.models[model_name][0]
+                probas_dataframes[model_name] = pd.DataFrame(
+                    model.predict_proba(single_cell_features),
+                    columns=model.classes_,
+                )
+
+        return probas_dataframes
+
+    def _get_feature_type_batches(
+        self, n_cells: int, feature_type_indices: Dict[str, np.ndarray]
+    ) -> List[List[str]]:
+        if self.n_workers <= 1:
+            return [[feature_type] for feature_type in feature_type_indices]
+
+        # estimate bytes needed to score a feature type (indexed float32 features with float64 scores and probabilities)
+        def feature_type_bytes(feature_type: str) -> int:
+            n_classes = sum(
+                len(self.models[model_name][0].classes_)
+                for model_name in self.feature_type_models[feature_type]
+            )
+            return n_cells * (
+                4 * len(feature_type_indices[feature_type]) + 16 * n_classes
+            )
+
+        return list(
+            task_utils.get_task_batches(
+                feature_type_indices, feature_type_bytes, self.memory_budget_gb
+            )
+        )
+
+    def get_probas_dataframes(
+        self, plate_features: pd.DataFrame, plate_schema: Optional[dict] = None
+    ) -> Dict[str, pd.DataFrame]:
+        """
+        Get probabilities for plate features from each model
+
+        Parameters
+        ----------
+        plate_features : pd.DataFrame
+            plate features to classify
+        plate_schema : Optional[dict], optional
+            schema of plate data (from load_plate_schema) with feature type column positions,
+            by default None (feature columns are found by name). plate features must have the schema's columns if given
+
+        Returns
+        -------
+        Dict[str, pd.DataFrame]
+            model names, each with dataframe of single-cell probabilities for classes from model
+            (same as get_probas_dataframe for each model)
+        """
+
+        # get features once, each feature type uses some of these feature columns
+        if plate_schema is not None:
+            feature_matrix = plate_features.iloc[
+                :, plate_schema["feature_indices"]
+            ].to_numpy()
+            # positions of feature type columns in feature matrix
+            feature_type_indices = {
+                feature_type: np.searchsorted(
+                    plate_schema["feature_indices"],
+                    plate_schema["feature_type_indices"][feature_type],
+                )
+                for feature_type in self.feature_type_models
+            }
+        else:
+            all_cols = plate_features.columns.to_list()
+            feature_cols = [col for col in all_cols if "P__" in col]
+            feature_matrix = plate_features[feature_cols].to_numpy()
+            feature_col_indices = {col: index for index, col in enumerate(feature_cols)}
+            feature_type_indices = {
+                feature_type: np.array(
+                    [
+                        feature_col_indices[col]
+                        for col in get_feature_cols(all_cols, feature_type)
+                    ],
+                    dtype=np.intp,
+                )
+                for feature_type in self.feature_type_models
+            }
+
+        probas_dataframes = {}
+        feature_type_batches = self._get_feature_type_batches(
+            feature_matrix.shape[0], feature_type_indices
+        )
+        if self.n_workers > 1:
+            with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+                for feature_type_batch in feature_type_batches:
+                    for feature_type_probas in executor.map(
+                        lambda feature_type: self._get_feature_type_probas(
+                            feature_type,
+                            feature_matrix,
+                            feature_type_indices[feature_type],
+                        ),
+                        feature_type_batch,
+                    ):
+                        probas_dataframes.update(feature_type_probas)
+        else:
+            for feature_type, feature_indices in feature_type_indices.items():
+                probas_dataframes.update(
+                    self._get_feature_type_probas(
+                        feature_type, feature_matrix, feature_indices
+                    )
+                )
+
+        # return probabilities in order models were given
+        return {model_name: probas_dataframes[model_name] for model_name in self.models}
+
+
+def get_plate_classifications_hash(
+    plate_classifications_dir: pathlib.Path,
+    plate: str,
+    file_format: Literal["csv.gz", "parquet"] = "csv.gz",
+    model_name: Optional[str] = None,
+) -> str:
+    """
+    get hash of the files classifications of a plate are loaded from (with their sizes and modification times),
+    so the hash changes if these files change
+
+    Parameters
+    ----------
+    plate_classifications_dir : pathlib.Path
+        path to plate classifications directory (with combined cell_classifications.parquet dataset if model_name is given)
+    plate : str
+        name of plate to get hash for
+    file_format : Literal["csv.gz", "parquet"], optional
+        format plate classifications are saved in, by default "csv.gz"
+    model_name : Optional[str], optional
+        name of model if classifications from all models are combined in one dataset, by default None
+
+    Returns
+    -------
+    str
+        hex digest of plate classifications hash
+    """
+
+    if model_name is not None or file_format == "parquet":
+        plate_classifications_files = sorted(
+            pathlib.Path(
+                f"{plate_classifications_dir}/cell_classifications.parquet/Metadata_Plate={plate}"
+            ).rglob("*.parquet")
+        )
+    else:
+        plate_classifications_files = [
+            pathlib.Path(
+                f"{plate_classifications_dir}/{plate}__cell_classifications.csv.gz"
+            )
+        ]
+
+    plate_classifications_hash = hashlib.sha1(f"{model_name}".encode())
+    for plate_classifications_file in plate_classifications_files:
+        file_stat = plate_classifications_file.stat()
+        plate_classifications_hash.update(
+            f"{plate_classifications_file.resolve()}:{file_stat.st_size}:{file_stat.st_mtime_ns}".encode()
+        )
+
+    return plate_classifications_hash.hexdigest()
+
+
+def get_plate_classification_aggregates(
+    plate_classifications_dir: pathlib.Path,
+    plate: str,
+    file_format: Literal["csv.gz", "parquet"] = "csv.gz",
+    model_name: Optional[str] = None,
+    chunksize: Optional[int] = None,
+    aggregates_cache_dir: Optional[pathlib.Path] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.Series]:
+    """
+    get sums and counts of class probabilities for each perturbation in a plate.
+    plate classifications are streamed (only perturbation and class probability columns are read), so memory use depends on the number of perturbations.
+    if a cache folder is given, aggregates are saved there keyed by the hash of the plate classification files
+    and only derived again if these files change (aggregates saved for earlier versions of these files are then removed)
+
+    Parameters
+    ----------
+    plate_classifications_dir : pathlib.Path
+        path to plate classifications directory
+    plate : str
+        name of plate to get aggregates for
+    file_format : Literal["csv.gz", "parquet"], optional
+        format plate classifications are saved in, by default "csv.gz"
+    model_name : Optional[str], optional
+        name of model to get aggregates for if classifications from all models are combined in one dataset
+        (plate_classifications_dir is then the folder with the combined cell_classifications.parquet dataset), by default None
+    chunksize : Optional[int], optional
+        number of cells to load at a time, by default None (load whole plate)
+    aggregates_cache_dir : Optional[pathlib.Path], optional
+        folder to save and load plate aggregates to/from, by default None (aggregates are not cached)
+
+    Returns
+    -------
+    Tuple[pd.DataFrame, pd.DataFrame, pd.Series]
+        float64 sums and int64 counts (of non-NaN probabilities) of class probabilities indexed by perturbation,
+        and the dtypes class probabilities were loaded as
+    """
+
+    def is_phenotypic_class(col: str) -> bool:
+        # class probability columns are all columns except metadata
+        return ("Metadata" not in col) and (
+            col not in ["Location_Center_X", "Location_Center_Y"]
+        )
+
+    if model_name is not None:
+        # combined classifications are only saved as parquet
+        file_format = "parquet"
+
+    if aggregates_cache_dir is not None:
+        # aggregates of the same plate classifications (same folder, format, and model) share a source hash,
+        # so aggregates saved before these classifications changed can be found and removed
+        source_hash = hashlib.sha1(
+            f"{pathlib.Path(plate_classifications_dir).resolve()}:{file_format}:{model_name}".encode()
+        ).hexdigest()[:16]
+        aggregates_cache_path = pathlib.Path(
+            f"{aggregates_cache_dir}/{plate}-{source_hash}-{get_plate_classifications_hash(plate_classifications_dir, plate, file_format, model_name)}.npz"
+        )
+        if aggregates_cache_path.is_file():
+            with np.load(aggregates_cache_path) as plate_aggregates:
+                perturbations = pd.Index(
+                    plate_aggregates["perturbations"].tolist(), name="Metadata_Reagent"
+                )
+                phenotypic_classes = plate_aggregates["phenotypic_classes"].tolist()
+                return (
+                    pd.DataFrame(
+                        plate_aggregates["sums"],
+                        index=perturbations,
+                        columns=phenotypic_classes,
+                    ),
+                    pd.DataFrame(
+                        plate_aggregates["counts"],
+                        index=perturbations,
+                        columns=phenotypic_classes,
+                    ),
+                    pd.Series(
+                        plate_aggregates["class_dtypes"].tolist(),
+                        index=phenotypic_classes,
+                        dtype=object,
+                    ),
+                )
+
+    if model_name is not None:
+        plate_classifications = plate_data_utils.load_model_classifications(
+            pathlib.Path(f"{plate_classifications_dir}/cell_classifications.parquet"),
+            plate,
+            model_name,
+            ["Metadata_Reagent"],
+            chunksize=chunksize,
+        )
+    elif file_format == "parquet":
+        # only load perturbation metadata and class probabilities from classifications dataset
+        plate_classifications_path = pathlib.Path(
+            f"{plate_classifications_dir}/cell_classifications.parquet"
+        )
+        plate_classifications = load_plate_data(
+            plate_classifications_path,
+            plate,
+            ["Metadata_Reagent"]
+            + [
+                col
+                for col in plate_data_utils.get_plate_data_columns(
+                    plate_classifications_path, file_format
+                )
+                if is_phenotypic_class(col)
+            ],
+            file_format,
+            chunksize=chunksize,
+        )
+    else:
+        plate_classifications_path = pathlib.Path(
+            f"{plate_classifications_dir}/{plate}__cell_classifications.csv.gz"
+        )
+        # first column is the saved index of multi-class model classifications
+        plate_classifications = pd.read_csv(
+            plate_classifications_path,
+            compression="gzip",
+            usecols=["Metadata_Reagent"]
+            + [
+                col
+                for col in pd.read_csv(
+                    plate_classifications_path, nrows=0, index_col=0
+                ).columns
+                if is_phenotypic_class(col)
+            ],
+            chunksize=chunksize,
+        )
+    if chunksize is None:
+        plate_classifications = [plate_classifications]
+
+    # running sums and counts of class probabilities for each perturbation
+    perturbation_sums, perturbation_counts, class_dtypes = None, None, None
+    for plate_classifications_chunk in plate_classifications:
+        if file_format == "parquet":
+            # perturbations are averaged across plates, so categories do not need to match between plates
+            plate_classifications_chunk[
+                "Metadata_Reagent"
+            ] = plate_classifications_chunk["Metadata_Reagent"].astype(str)
+        phenotypic_classes = [
+            col
+            for col in plate_classifications_chunk.columns
+            if is_phenotypic_class(col)
+        ]
+        if class_dtypes is None:
+            class_dtypes = plate_classifications_chunk[phenotypic_classes].dtypes
+        # sum probabilities as float64 so sums of float32 probabilities do not lose precision
+        perturbation_groups = plate_classifications_chunk.astype(
+            {col: np.float64 for col in phenotypic_classes}
+        ).groupby("Metadata_Reagent")[phenotypic_classes]
+        if perturbation_sums is None:
+            perturbation_sums = perturbation_groups.sum()
+            perturbation_counts = perturbation_groups.count()
+        else:
+            perturbation_sums = perturbation_sums.add(
+                perturbation_groups.sum(), fill_value=0
+            )
+            perturbation_counts = perturbation_counts.add(
+                perturbation_groups.count(), fill_value=0
+            )
+    perturbation_counts = perturbation_counts.astype(np.int64)
+    class_dtypes = class_dtypes.astype(str).astype(object)
+
+    if aggregates_cache_dir is not None:
+        # write cache to a temporary file first so an interrupted write is not loaded later
+        aggregates_cache_path.parent.mkdir(exist_ok=True, parents=True)
+        temp_cache_path = pathlib.Path(
+            f"{aggregates_cache_path}.{uuid.uuid4().hex[:8]}.tmp"
+        )
+        # save to an open file so np.savez does not add .npz to the temporary file name
+        with open(temp_cache_path, "wb") as temp_cache_file:
+            np.savez(
+                temp_cache_file,
+                perturbations=np.array(perturbation_sums.index, dtype=str),
+                phenotypic_classes=np.array(perturbation_sums.columns, dtype=str),
+                class_dtypes=np.array(class_dtypes, dtype=str),
+                sums=perturbation_sums.to_numpy(dtype=np.float64),
+                counts=perturbation_counts.to_numpy(dtype=np.int64),
+            )
+        temp_cache_path.replace(aggregates_cache_path)
+
+        # remove aggregates saved before the plate classifications changed
+        for stale_cache_path in aggregates_cache_path.parent.glob(
+            f"{plate}-{source_hash}-*.npz"
+        ):
+            if stale_cache_path != aggregates_cache_path:
+                stale_cache_path.unlink(missing_ok=True)
+
+    return perturbation_sums, perturbation_counts, class_dtypes
+
+
+def load_cell_health_labels(
+    cell_health_hash: str,
+    cache_dir: pathlib.Path,
+    source: Optional[Union[str, pathlib.Path]] = None,
+    sha256: Optional[str] = None,
+) -> pd.DataFrame:
+    """
+    load cell health consensus label profiles (cell_health_median.tsv.gz) from a local cache keyed by cell health repository hash.
+    label profiles are only fetched from their source if they are not cached yet,
+    and are then cached as parquet (with the sha256 checksum of the fetched file in the parquet metadata)
+
+    Parameters
+    ----------
+    cell_health_hash : str
+        commit hash of cell health repository to load label profiles from
+    cache_dir : pathlib.Path
+        folder to cache label profiles in
+    source : Optional[Union[str, pathlib.Path]], optional
+        URL or local path to fetch cell_health_median.tsv.gz from, by default None (fetch from the cell health repository on GitHub)
+    sha256 : Optional[str], optional
+        sha256 checksum the fetched (or cached) file must have, by default None (checksum is not verified)
+
+    Returns
+    -------
+    pd.DataFrame
+        cell health consensus label profiles (with the sha256 checksum of the fetched file in attrs["source_sha256"])
+
+    Raises
+    ------
+    ValueError
+        thrown if the fetched file, or the file label profiles were cached from, does not have the given sha256 checksum
+    """
+
+    cache_path = pathlib.Path(
+        f"{cache_dir}/cell_health_median-{cell_health_hash}.parquet"
+    )
+    if cache_path.is_file():
+        # cached label profiles must also have been fetched from a file with the given checksum
+        cached_sha256 = (
+            (pq.read_schema(cache_path).metadata or {})
+            .get(b"source_sha256", b"")
+            .decode()
+        )
+        if sha256 is not None and cached_sha256 != sha256:
+            raise ValueError(
+                f"sha256 checksum of the file cached in {cache_path} is {cached_sha256 or 'unknown'}, not {sha256}! "
+                "Remove the cached file to fetch label profiles again."
+            )
+        cell_health_labels = pd.read_parquet(cache_path)
+        cell_health_labels.attrs["source_sha256"] = cached_sha256
+        return cell_health_labels
+
+    # fetch label profiles from URL (http, https, or file) or local path
+    if source is None:
+        source = CELL_HEALTH_LABELS_URL.format(cell_health_hash=cell_health_hash)
+    if "://" in str(source):
+        with urllib.request.urlopen(str(source)) as labels_response:
+            labels_bytes = labels_response.read()
+    else:
+        labels_bytes = pathlib.Path(source).read_bytes()
+
+    labels_sha256 = hashlib.sha256(labels_bytes).hexdigest()
+    if sha256 is not None and labels_sha256 != sha256:
+        raise ValueError(
+            f"sha256 checksum of {source} is {labels_sha256}, not {sha256}!"
+        )
+    cell_health_labels = pd.read_csv(
+        io.BytesIO(labels_bytes), compression="gzip", sep="\t"
+    )
+
+    # write cache to a temporary file first so an interrupted write is not loaded later
+    labels_table = pa.Table.from_pandas(cell_health_labels, preserve_index=False)
+    labels_table = labels_table.replace_schema_metadata(
+        {
+            **labels_table.schema.metadata,
+            b"source": str(source).encode(),
+            b"source_sha256": labels_sha256.encode(),
+        }
+    )
+    cache_path.parent.mkdir(exist_ok=True, parents=True)
+    temp_cache_path = pathlib.Path(f"{cache_path}.{uuid.uuid4().hex[:8]}.tmp")
+    pq.write_table(labels_table, temp_cache_path)
+    temp_cache_path.replace(cache_path)
+
+    cell_health_labels.attrs["source_sha256"] = labels_sha256
+    return cell_health_labels
+
+
 def create_classification_profiles(
-    plate_classifications_dir: pathlib.Path, cell_line_plates: dict
+    plate_classifications_dir: pathlib.Path,
+    cell_line_plates: dict,
+    file_format: Literal["csv.gz", "parquet"] = "csv.gz",
+    model_name: Optional[str] = None,
+    chunksize: Optional[int] = None,
+    aggregates_cache_dir: Optional[pathlib.Path] = None,
 ) -> pd.DataFrame:
     """
     create classsification profiles for correlation to cell health label profiles
-    a classification profile consists of classification probabilities averaged across perturbation and cell line
+    a classification profile consists of classification probabilities averaged across perturbation and cell line.
+    profiles are assembled from sums and counts of class probabilities for each perturbation in each plate (see get_plate_classification_aggregates),
+    so memory use depends on the number of perturbations and not on the number of cells
 
     Parameters
     ----------
@@ -72,6 +816,16 @@ def create_classification_profiles(
         path to plate classifications directory
     cell_line_plates : dict
         cell line names, each with a list of plate names that are correlated to their respective cell line
+    file_format : Literal["csv.gz", "parquet"], optional
+        format plate classifications are saved in, by default "csv.gz"
+    model_name : Optional[str], optional
+        name of model to create profiles for if classifications from all models are combined in one dataset
+        (plate_classifications_dir is then the folder with the combined cell_classifications.parquet dataset), by default None
+    chunksize : Optional[int], optional
+        number of cells to load at a time, by default None (load one whole plate at a time)
+    aggregates_cache_dir : Optional[pathlib.Path], optional
+        folder to cache plate aggregates in, by default None (aggregates are not cached).
+        aggregates are only derived again if plate classifications change, so profiles for a new cell line/plate mapping are assembled from cached aggregates
 
     Returns
     -------
@@ -82,49 +836,46 @@ def create_classification_profiles(
     cell_line_classification_profiles = []
 
     for cell_line in cell_line_plates:
-        # create one large dataframe for all 3 plates in the particular cell line
-        cell_line_plate_names = cell_line_plates[cell_line]
-        cell_line_plate_classifications = []
-        for cell_line_plate_name in cell_line_plate_names:
-            plate_classifications = pathlib.Path(
-                f"{plate_classifications_dir}/{cell_line_plate_name}__cell_classifications.csv.gz"
-            )
-            plate_classifications = pd.read_csv(
-                plate_classifications, compression="gzip", index_col=0
+        # sums and counts of class probabilities for each perturbation across all plates of the cell line
+        perturbation_sums, perturbation_counts, class_dtypes = None, None, None
+        for cell_line_plate_name in cell_line_plates[cell_line]:
+            (
+                plate_perturbation_sums,
+                plate_perturbation_counts,
+                plate_class_dtypes,
+            ) = get_plate_classification_aggregates(
+                plate_classifications_dir,
+                cell_line_plate_name,
+                file_format,
+                model_name,
+                chunksize,
+                aggregates_cache_dir,
             )
-            cell_line_plate_classifications.append(plate_classifications)
-
-        cell_line_plate_classifications = pd.concat(
-            cell_line_plate_classifications, axis=0
-        ).reset_index(drop=True)
+            if perturbation_sums is None:
+                perturbation_sums = plate_perturbation_sums
+                perturbation_counts = plate_perturbation_counts
+                class_dtypes = plate_class_dtypes
+            else:
+                perturbation_sums = perturbation_sums.add(
+                    plate_perturbation_sums, fill_value=0
+                )
+                perturbation_counts = perturbation_counts.add(
+                    plate_perturbation_counts, fill_value=0
+                )
 
-        # create dataframe with cell classifications averaged across perturbation, include cell line metadata
-        # add cell line metadata
-        cell_line_plate_classifications["Metadata_cell_line"] = cell_line
+        # average across perturbation (classes are saved in the dtype they were loaded as)
+        cell_line_classification_profile = (
+            (perturbation_sums / perturbation_counts).astype(class_dtypes).sort_index()
+        )
         # rename perturbation column to match the format of cell health label profiles, in this case "perturbation" corresponds to "reagent" because DeepProfiler (used much earlier in pipeline) makes no distinction
-        cell_line_plate_classifications = cell_line_plate_classifications.rename(
-            columns={"Metadata_Reagent": "Metadata_pert_name"}
+        # and include cell line metadata
+        cell_line_classification_profile.index = pd.MultiIndex.from_arrays(
+            [
+                cell_line_classification_profile.index,
+                [cell_line] * cell_line_classification_profile.shape[0],
+            ],
+            names=["Metadata_pert_name", "Metadata_cell_line"],
         )
-
-        # get rid of extra metadata columns
-        phenotypic_classes = [
-            col
-            for col in cell_line_plate_classifications.columns.tolist()
-            if ("Metadata" not in col)
-            and (col not in ["Location_Center_X", "Location_Center_Y"])
-        ]
-        columns_to_keep = [
-            "Metadata_pert_name",
-            "Metadata_cell_line",
-        ] + phenotypic_classes
-        cell_line_plate_classifications = cell_line_plate_classifications[
-            columns_to_keep
-        ]
-
-        # average across perturbation
-        cell_line_classification_profile = cell_line_plate_classifications.groupby(
-            ["Metadata_pert_name", "Metadata_cell_line"]
-        ).mean()
         cell_line_classification_profiles.append(cell_line_classification_profile)
 
     classification_profiles = pd.concat(cell_line_classification_profiles, axis=0)
@@ -138,3 +889,425 @@ def create_classification_profiles(
     )
 
     return classification_profiles
+
+
+def derive_classification_profiles_task(
+    profile_task: Tuple[str, pathlib.Path, dict]
+) -> Tuple[str, float]:
+    """
+    helper function for derive_classification_profiles
+    derive classification profiles for one task and save them as a TSV file
+
+    Parameters
+    ----------
+    profile_task : Tuple[str, pathlib.Path, dict]
+        task name, path to save classification profiles to, and keyword arguments for create_classification_profiles
+
+    Returns
+    -------
+    Tuple[str, float]
+        task name and seconds taken to derive and save classification profiles
+    """
+
+    task_name, save_path, profile_kwargs = profile_task
+    start_time = time.perf_counter()
+
+    classification_profiles = create_classification_profiles(**profile_kwargs)
+    save_path.parent.mkdir(exist_ok=True, parents=True)
+    classification_profiles.to_csv(save_path, sep="\t", index=False)
+
+    return task_name, time.perf_counter() - start_time
+
+
+def derive_classification_profiles(
+    profile_tasks: List[Tuple[str, pathlib.Path, dict]], n_workers: int = 1
+) -> None:
+    """
+    derive and save classification profiles for many models (each model's classifications are independent),
+    printing the time each task takes as it finishes
+
+    Parameters
+    ----------
+    profile_tasks : List[Tuple[str, pathlib.Path, dict]]
+        tasks with a name (used in the log), path to save classification profiles to,
+        and keyword arguments for create_classification_profiles
+    n_workers : int, optional
+        number of processes to derive classification profiles with, by default 1 (tasks are run one after another)
+    """
+
+    start_time = time.perf_counter()
+
+    if n_workers > 1:
+        with mp.Pool(processes=n_workers) as pool:
+            for task_name, task_seconds in pool.imap_unordered(
+                derive_classification_profiles_task, profile_tasks
+            ):
+                print(
+                    f"Derived classification profiles for {task_name} in {task_seconds:.1f}s"
+                )
+    else:
+        for profile_task in profile_tasks:
+            task_name, task_seconds = derive_classification_profiles_task(profile_task)
+            print(
+                f"Derived classification profiles for {task_name} in {task_seconds:.1f}s"
+            )
+
+    print(
+        f"Derived {len(profile_tasks)} classification profiles in {time.perf_counter() - start_time:.1f}s"
+    )
+
+
+class ProfileCorrelationEngine:
+    """
+    Correlate classification profiles of many models to cell health label profiles at once.
+    Profiles and labels are aligned on perturbation and cell line, and the class columns of all models are stacked,
+    so Pearson and Spearman (Pearson of ranks) correlations between every class and label are computed with one matrix multiplication.
+    Each class and label are correlated on the profiles where neither is NaN (classes and labels with NaN values in the same profiles are correlated together).
+    Permutation p-values shuffle label profiles across perturbations in batches of permutations,
+    with every permutation correlating all classes and labels at once.
+
+    Parameters
+    ----------
+    cell_health_labels : pd.DataFrame
+        cell health consensus label profiles (from load_cell_health_labels)
+    n_permutations : int, optional
+        number of label permutations used to derive p-values, by default 0 (p-values are not derived)
+    random_state : int, optional
+        seed for label permutations, by default 0
+    permutation_batch_size : int, optional
+        number of permutations correlated at once, by default 100
+    """
+
+    # columns profiles and labels are aligned on
+    PROFILE_KEYS = ["Metadata_pert_name", "Metadata_cell_line"]
+
+    def __init__(
+        self,
+        cell_health_labels: pd.DataFrame,
+        n_permutations: int = 0,
+        random_state: int = 0,
+        permutation_batch_size: int = 100,
+    ):
+        label_cols = [
+            col
+            for col in cell_health_labels.columns
+            if not col.startswith("Metadata_")
+            and pd.api.types.is_numeric_dtype(cell_health_labels[col])
+        ]
+        self.cell_health_labels = cell_health_labels.set_index(self.PROFILE_KEYS)[
+            label_cols
+        ]
+        self.n_permutations = n_permutations
+        self.random_state = random_state
+        self.permutation_batch_size = permutation_batch_size
+
+    @staticmethod
+    def _get_standardized(values: np.ndarray) -> np.ndarray:
+        # columns with no variance are NaN after standardizing, so their correlations are NaN
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (values - values.mean(axis=0)) / values.std(axis=0)
+
+    @staticmethod
+    def _get_nan_groups(values: np.ndarray) -> List[Tuple[np.ndarray, np.ndarray]]:
+        # group columns with NaN values in the same rows, with the rows that are not NaN in each group
+        is_valid = ~np.isnan(values)
+        valid_patterns, pattern_indices = np.unique(
+            is_valid.T, axis=0, return_inverse=True
+        )
+        pattern_indices = pattern_indices.reshape(-1)
+        return [
+            (valid_rows, np.flatnonzero(pattern_indices == pattern_index))
+            for pattern_index, valid_rows in enumerate(valid_patterns)
+        ]
+
+    def _get_group_correlations(
+        self,
+        profile_values: np.ndarray,
+        label_values: np.ndarray,
+        rng: np.random.Generator,
+    ) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        # correlate profiles and labels without NaN values
+        n_profiles = profile_values.shape[0]
+        method_values = {
+            "pearson": (profile_values, label_values),
+            "spearman": (
+                rankdata(profile_values, axis=0),
+                rankdata(label_values, axis=0),
+            ),
+        }
+        method_standardized = {
+            method: (self._get_standardized(profiles), self._get_standardized(labels))
+            for method, (profiles, labels) in method_values.items()
+        }
+        method_correlations = {
+            method: profiles.T @ labels / n_profiles
+            for method, (profiles, labels) in method_standardized.items()
+        }
+
+        if self.n_permutations <= 0:
+            return {
+                method: (correlations, np.full(correlations.shape, np.nan))
+                for method, correlations in method_correlations.items()
+            }
+
+        # count permutations with correlations at least as extreme as observed correlations
+        method_counts = {
+            method: np.zeros(correlations.shape, dtype=np.int64)
+            for method, correlations in method_correlations.items()
+        }
+        for batch_start in range(0, self.n_permutations, self.permutation_batch_size):
+            batch_size = min(
+                self.permutation_batch_size, self.n_permutations - batch_start
+            )
+            # each row is a permutation of profile rows (same permutations for every method)
+            permutations = np.argsort(rng.random((batch_size, n_profiles)), axis=1)
+            for method, (profiles, labels) in method_standardized.items():
+                permuted_correlations = profiles.T @ labels[permutations] / n_profiles
+                method_counts[method] += (
+                    np.abs(permuted_correlations)
+                    >= np.abs(method_correlations[method]) - 1e-12
+                ).sum(axis=0)
+
+        method_results = {}
+        for method, correlations in method_correlations.items():
+            p_values = (method_counts[method] + 1) / (self.n_permutations + 1)
+            # correlations of columns with no variance are NaN, and so are their p-values
+            p_values[np.isnan(correlations)] = np.nan
+            method_results[method] = (correlations, p_values)
+
+        return method_results
+
+    def _get_correlations(
+        self, profile_values: np.ndarray, label_values: np.ndarray
+    ) -> Tuple[Dict[str, Tuple[np.ndarray, np.ndarray]], np.ndarray]:
+        n_classes, n_labels = profile_values.shape[1], label_values.shape[1]
+        method_results = {
+            method: (
+                np.full((n_classes, n_labels), np.nan),
+                np.full((n_classes, n_labels), np.nan),
+            )
+            for method in ["pearson", "spearman"]
+        }
+        n_profiles = np.zeros((n_classes, n_labels), dtype=np.int64)
+
+        # each class and label are correlated on the profiles where neither is NaN (as scipy does with nan_policy="omit"),
+        # so classes and labels are correlated in groups of columns with NaN values in the same rows
+        # (profiles without NaN values are correlated in one group)
+        rng = np.random.default_rng(self.random_state)
+        for profile_rows, class_indices in self._get_nan_groups(profile_values):
+            for label_rows, label_indices in self._get_nan_groups(label_values):
+                rows = profile_rows & label_rows
+                group_indices = np.ix_(class_indices, label_indices)
+                n_profiles[group_indices] = rows.sum()
+                if rows.sum() < 2:
+                    continue
+
+                group_results = self._get_group_correlations(
+                    profile_values[np.ix_(rows, class_indices)],
+                    label_values[np.ix_(rows, label_indices)],
+                    rng,
+                )
+                for method, (correlations, p_values) in group_results.items():
+                    method_results[method][0][group_indices] = correlations
+                    method_results[method][1][group_indices] = p_values
+
+        return method_results, n_profiles
+
+    def get_correlations(
+        self,
+        classification_profiles: Dict[str, pd.DataFrame],
+        by_cell_line: bool = False,
+    ) -> pd.DataFrame:
+        """
+        Get correlations between the classes of each model's classification profiles and cell health labels
+
+        Parameters
+        ----------
+        classification_profiles : Dict[str, pd.DataFrame]
+            model names, each with classification profiles dataframe (from create_classification_profiles)
+        by_cell_line : bool, optional
+            whether to also correlate profiles of each cell line separately, by default False
+            (only profiles of all cell lines together are correlated, with cell line "all")
+
+        Returns
+        -------
+        pd.DataFrame
+            tidy dataframe with model name, phenotypic class, cell health label, cell line, correlation method,
+            number of profiles correlated (profiles where class and label are not NaN), correlation,
+            and permutation p-value (NaN if no permutations were derived or the correlation is NaN) of each correlation
+        """
+
+        # align class columns of all models with label profiles
+        model_profiles = pd.concat(
+            {
+                model_name: profiles.set_index(self.PROFILE_KEYS)[
+                    [col for col in profiles.columns if not col.startswith("Metadata_")]
+                ]
+                for model_name, profiles in classification_profiles.items()
+            },
+            axis=1,
+            join="inner",
+        )
+        profile_index = model_profiles.index.intersection(self.cell_health_labels.index)
+        model_profiles = model_profiles.loc[profile_index]
+        class_cols = model_profiles.columns
+        profile_values = model_profiles.to_numpy(dtype=np.float64)
+        label_values = self.cell_health_labels.loc[profile_index].to_numpy(
+            dtype=np.float64
+        )
+
+        cell_line_rows = {"all": np.ones(model_profiles.shape[0], dtype=bool)}
+        if by_cell_line:
+            profile_cell_lines = model_profiles.index.get_level_values(
+                "Metadata_cell_line"
+            )
+            for cell_line in profile_cell_lines.unique():
+                cell_line_rows[cell_line] = profile_cell_lines == cell_line
+
+        n_classes, n_labels = len(class_cols), self.cell_health_labels.shape[1]
+        correlation_dataframes = []
+        for cell_line, rows in cell_line_rows.items():
+            method_results, n_profiles = self._get_correlations(
+                profile_values[rows], label_values[rows]
+            )
+            for method, (correlations, p_values) in method_results.items():
+                correlation_dataframes.append(
+                    pd.DataFrame(
+                        {
+                            "model_name": np.repeat(
+                                class_cols.get_level_values(0), n_labels
+                            ),
+                            "phenotypic_class": np.repeat(
+                                class_cols.get_level_values(1), n_labels
+                            ),
+                            "cell_health_label": np.tile(
+                                self.cell_health_labels.columns, n_classes
+                            ),
+                            "Metadata_cell_line": cell_line,
+                            "method": method,
+                            "n_profiles": n_profiles.ravel(),
+                            "correlation": correlations.ravel(),
+                            "p_value": p_values.ravel(),
+                        }
+                    )
+                )
+
+        return pd.concat(correlation_dataframes, ignore_index=True)
+
+
+def load_normalization_params(
+    normalization_params_path: pathlib.Path, feature_cols: List[str]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    load normalization parameters (saved as npz file in 3.preprocess-features) for feature columns
+
+    Parameters
+    ----------
+    normalization_params_path : pathlib.Path
+        path to npz file with center, scale, and feature_names arrays
+    feature_cols : List[str]
+        feature columns to get normalization parameters for
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        center and scale arrays for feature columns (in order of feature columns)
+    """
+
+    with np.load(normalization_params_path) as normalization_params:
+        feature_indices = pd.Index(normalization_params["feature_names"]).get_indexer(
+            feature_cols
+        )
+        if (feature_indices == -1).any():
+            raise ValueError(
+                f"Normalization parameters not found for all features in {normalization_params_path}!"
+            )
+        return (
+            normalization_params["center"][feature_indices],
+            normalization_params["scale"][feature_indices],
+        )
+
+
+def load_plate_data(
+    plate_data_path: pathlib.Path,
+    plate: str,
+    columns: List[str],
+    file_format: Literal["csv.gz", "parquet"] = "csv.gz",
+    normalization_params_path: Optional[pathlib.Path] = None,
+    chunksize: Optional[int] = None,
+) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+    """
+    load columns of single-cell data for one plate with features as float32.
+    only the plate's partition and the given columns are read from a parquet dataset.
+    if normalization parameters are given, merged features are normalized as they are loaded (so normalized plates do not need to be saved)
+
+    Parameters
+    ----------
+    plate_data_path : pathlib.Path
+        path to compressed csv file with plate data or to parquet dataset folder
+    plate : str
+        name of plate to load data for
+    columns : List[str]
+        columns to load
+    file_format : Literal["csv.gz", "parquet"], optional
+        format plate data is saved in, by default "csv.gz"
+    normalization_params_path : Optional[pathlib.Path], optional
+        path to npz file with plate normalization parameters, by default None (load features as saved)
+    chunksize : Optional[int], optional
+        number of cells to load at a time, by default None (load whole plate)
+
+    Returns
+    -------
+    Union[pd.DataFrame, Iterator[pd.DataFrame]]
+        single-cell data for plate, or iterator of single-cell data chunks if chunksize is given
+    """
+
+    feature_cols = [col for col in columns if "P__" in col]
+    if normalization_params_path is not None and len(feature_cols) > 0:
+        center, scale = load_normalization_params(
+            normalization_params_path, feature_cols
+        )
+    else:
+        center, scale = None, None
+
+    def format_plate_data(plate_data: pd.DataFrame) -> pd.DataFrame:
+        if file_format != "parquet":
+            # csv columns are loaded in file order
+            plate_data = plate_data.reindex(columns=columns)
+        if center is not None:
+            features = plate_data[feature_cols].to_numpy(dtype=np.float32, copy=True)
+            features -= center
+            features /= scale
+            plate_data[feature_cols] = features
+        return plate_data
+
+    if file_format == "parquet":
+        plate_dataset = ds.dataset(
+            plate_data_path,
+            format="parquet",
+            partitioning=plate_data_utils.PLATE_DATA_PARTITIONING,
+        )
+        if chunksize is None:
+            return format_plate_data(
+                plate_dataset.to_table(
+                    columns=columns, filter=ds.field("Metadata_Plate") == plate
+                ).to_pandas()
+            )
+        return (
+            format_plate_data(plate_batch.to_pandas())
+            for plate_batch in plate_dataset.to_batches(
+                columns=columns,
+                filter=ds.field("Metadata_Plate") == plate,
+                batch_size=chunksize,
+            )
+        )
+
+    plate_data = pd.read_csv(
+        plate_data_path,
+        usecols=columns,
+        dtype={col: np.float32 for col in feature_cols},
+        chunksize=chunksize,
+    )
+    if chunksize is None:
+        return format_plate_data(plate_data)
+    return (format_plate_data(plate_data_chunk) for plate_data_chunk in plate_data)
@@ -0,0 +1,113 @@
+import pathlib
+import sys
+
+import numpy as np
+import pandas as pd
+from scipy.stats import pearsonr, spearmanr
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+import classification_utils
+
+
+def get_profiles_and_labels() -> tuple:
+    rng = np.random.default_rng(0)
+    profile_keys = pd.DataFrame(
+        [
+            (f"pert_{pert_index}", cell_line)
+            for cell_line in ["A549", "ES2"]
+            for pert_index in range(30)
+        ],
+        columns=["Metadata_pert_name", "Metadata_cell_line"],
+    )
+
+    cell_health_labels = profile_keys.copy()
+    cell_health_labels["Metadata_profile_id"] = "profile"
+    for label_index in range(3):
+        cell_health_labels[f"cc_label_{label_index}"] = rng.normal(
+            size=profile_keys.shape[0]
+        )
+    # labels with NaN values in different profiles, and a label with no variance
+    cell_health_labels.loc[[0, 5, 40], "cc_label_1"] = np.nan
+    cell_health_labels.loc[[3, 33], "cc_label_2"] = np.nan
+    cell_health_labels["cc_constant"] = 1.0
+
+    classification_profiles = profile_keys.copy()
+    classification_profiles["Metadata_Reagent"] = "reagent"
+    classification_profiles["Interphase"] = cell_health_labels[
+        "cc_label_0"
+    ] + rng.normal(size=profile_keys.shape[0])
+    classification_profiles["Mitosis"] = rng.normal(size=profile_keys.shape[0])
+    # class with NaN values (no cells of a perturbation were classified)
+    classification_profiles.loc[[7, 50], "Mitosis"] = np.nan
+
+    return {"model": classification_profiles}, cell_health_labels
+
+
+def test_profile_correlations_match_scipy():
+    classification_profiles, cell_health_labels = get_profiles_and_labels()
+    correlation_engine = classification_utils.ProfileCorrelationEngine(
+        cell_health_labels, n_permutations=200
+    )
+    correlations = correlation_engine.get_correlations(
+        classification_profiles, by_cell_line=True
+    )
+
+    profiles = classification_profiles["model"]
+    for _, correlation in correlations.iterrows():
+        rows = (
+            np.ones(profiles.shape[0], dtype=bool)
+            if correlation["Metadata_cell_line"] == "all"
+            else (
+                profiles["Metadata_cell_line"] == correlation["Metadata_cell_line"]
+            ).to_numpy()
+        )
+        class_values = profiles.loc[rows, correlation["phenotypic_class"]].to_numpy()
+        label_values = cell_health_labels.loc[
+            rows, correlation["cell_health_label"]
+        ].to_numpy()
+        is_valid = ~np.isnan(class_values) & ~np.isnan(label_values)
+        assert correlation["n_profiles"] == is_valid.sum()
+
+        if correlation["cell_health_label"] == "cc_constant":
+            # correlations with labels with no variance are NaN, and so are their p-values
+            assert np.isnan(correlation["correlation"])
+            assert np.isnan(correlation["p_value"])
+            continue
+
+        correlation_function = (
+            pearsonr if correlation["method"] == "pearson" else spearmanr
+        )
+        expected_correlation, _ = correlation_function(
+            class_values[is_valid], label_values[is_valid]
+        )
+        assert np.isclose(correlation["correlation"], expected_correlation)
+        assert 0 < correlation["p_value"] <= 1
+
+
+def test_profile_correlations_without_nan_values_use_all_profiles():
+    classification_profiles, cell_health_labels = get_profiles_and_labels()
+    cell_health_labels = cell_health_labels.drop(columns=["cc_label_1", "cc_label_2"])
+    classification_profiles["model"] = classification_profiles["model"].drop(
+        columns=["Mitosis"]
+    )
+    correlation_engine = classification_utils.ProfileCorrelationEngine(
+        cell_health_labels
+    )
+    correlations = correlation_engine.get_correlations(classification_profiles)
+
+    assert (correlations["n_profiles"] == cell_health_labels.shape[0]).all()
+    # p-values are not derived without permutations
+    assert correlations["p_value"].isna().all()
+
+    label_correlations = correlations.loc[
+        correlations["cell_health_label"] == "cc_label_0"
+    ].set_index("method")["correlation"]
+    profiles = classification_profiles["model"]
+    assert np.isclose(
+        label_correlations["pearson"],
+        pearsonr(profiles["Interphase"], cell_health_labels["cc_label_0"])[0],
+    )
+    assert np.isclose(
+        label_correlations["spearman"],
+        spearmanr(profiles["Interphase"], cell_health_labels["cc_label_0"])[0],
+    )
@@ -5,19 +5,23 @@
 # We compare the treatments in each well using cell treatment probabilities and negative control probabilities for each phenotype.
 # This comparison is accomplished with a KS Test.
 
-# In[1]:
+# In[ ]:
 
 
 import pathlib
 import sys
 
 import pandas as pd
-from scipy.stats import kstest
+import pyarrow.dataset as ds
 
 # Import significance test utils
 sys.path.append("utils")
 import well_significance_testing as sig_test
 
+# Import utils for the plate data format shared by all modules
+sys.path.append("../utils")
+import plate_data_utils
+
 
 # ## Find the root of the git repo on the host system
 
@@ -44,7 +48,7 @@ if root_dir is None:
 
 # ## Input and Output Paths
 
-# In[3]:
+# In[ ]:
 
 
 # Input paths
@@ -61,9 +65,44 @@ shuf_proba_path = proba_path / "shuffled_baseline__CP_areashape_only__balanced"
 # Platemap metadata
 platemapdf = pd.read_csv(f"{root_dir}/0.image-download/manifest/idr0080-screenA-annotation.csv")
 
-# Load probability data for final and shuffled models
-final_probadf = pd.concat([pd.read_csv(data_file, index_col=0) for data_file in list(final_proba_path.glob("*.csv.gz"))])
-shuf_probadf = pd.concat([pd.read_csv(data_file, index_col=0) for data_file in list(shuf_proba_path.glob("*.csv.gz"))])
+# Format probability data is saved in ("csv.gz" or "parquet")
+file_format = "csv.gz"
+
+# Whether probability data of all models is combined in one parquet dataset (saved in the folder above proba_path)
+combine_model_classifications = False
+
+def load_proba_data(_model_proba_path):
+    """
+    Parameters
+    ----------
+    _model_proba_path: pathlib.Path
+        The path to the probability data of one model (a folder of plate csv.gz files or one parquet dataset partitioned by plate and well).
+        With combined probability data, only the columns of this model are loaded from the combined dataset.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The predicted probabilities and metadata of all cells classified by the model.
+    """
+    if combine_model_classifications:
+        # Only load the plate and well metadata with the phenotype probabilities of this model (converted back to float32 if they were quantized)
+        return plate_data_utils.load_model_classifications(_model_proba_path.parents[1] / "cell_classifications.parquet", None, f"{_model_proba_path.parent.name}/{_model_proba_path.name}", ["Metadata_Plate", "Metadata_Well"])
+
+    if file_format == "parquet":
+        proba_dataset = ds.dataset(_model_proba_path / "cell_classifications.parquet", format="parquet", partitioning=plate_data_utils.PLATE_DATA_PARTITIONING)
+
+        # Only load the plate and well metadata with the phenotype probabilities
+        proba_cols = [col for col in proba_dataset.schema.names if col in ["Metadata_Plate", "Metadata_Well"] or not col.startswith(("Metadata_", "Location_"))]
+        return proba_dataset.to_table(columns=proba_cols).to_pandas()
+
+    return pd.concat([pd.read_csv(data_file, index_col=0) for data_file in list(_model_proba_path.glob("*.csv.gz"))])
+
+# Load data and compare wells only when run as the main script
+# (worker processes started with spawn, the default on macOS and Windows, import this script to use perform_ks_test without loading the data)
+if __name__ == "__main__":
+    # Load probability data for final and shuffled models
+    final_probadf = load_proba_data(final_proba_path)
+    shuf_probadf = load_proba_data(shuf_proba_path)
 
 # Output paths
 comparison_results_output_filename = "class_balanced_well_log_reg_areashape_greg_model_comparisons.parquet"
@@ -73,60 +112,67 @@ output_path.mkdir(parents=True, exist_ok=True)
 
 # ## KS test wrapper function
 
-# In[4]:
+# In[ ]:
 
 
 def perform_ks_test(_dmso_probs, _treatment_probs):
     """
     Parameters
     ----------
-    _dmso_probs: pandas.Series
-        The down-sampled predicted probilities of DMSO for a treatment type and phenotype.
+    _dmso_probs: numpy.ndarray
+        The down-sampled predicted probilities of DMSO for a treatment type, with one sorted column for each phenotype.
 
-    _treatment_probs: pandas.Series
-        The predicted probabilities of the treatment.
+    _treatment_probs: numpy.ndarray
+        The predicted probabilities of the treatment, with one column for each phenotype.
 
     Returns
     -------
     A zipped object which represents can be referenced by p_value and a comparison_metric_value, which are later on represented in the resulting dictionary.
+    The KS test of every phenotype is performed at once, so each value is an array with the result of each phenotype.
     """
-    stat, p_value = kstest(_dmso_probs, _treatment_probs, alternative="two-sided")
+    stat, p_value = sig_test.ks_2samp_batched(_dmso_probs, _treatment_probs, _con_sorted=True)
     return zip(["comparison_metric_value", "p_value"], [stat, p_value])
 
 
 # ## Combine shuffled and final model data
 
-# In[5]:
+# In[ ]:
 
 
-# Define the type of model
-final_probadf["Metadata_Model_Type"] = "final"
-shuf_probadf["Metadata_Model_Type"] = "shuffled"
+# Only run as the main script (see above)
+if __name__ == "__main__":
+    # Define the type of model
+    final_probadf["Metadata_Model_Type"] = "final"
+    shuf_probadf["Metadata_Model_Type"] = "shuffled"
 
-probadf = pd.concat([final_probadf, shuf_probadf])
+    probadf = pd.concat([final_probadf, shuf_probadf])
 
 
 # ## Merge the platemap and probability data
 
-# In[6]:
+# In[ ]:
 
 
-platemap_metacols = ["Plate", "Well"]
-platemap_cols = ["Reagent Identifier", "Characteristics [Cell Line]", "Control Type"]
-probadf = probadf.merge(platemapdf[platemap_cols + platemap_metacols], how="inner", left_on=["Metadata_Plate", "Metadata_Well"], right_on=platemap_metacols)
+# Only run as the main script (see above)
+if __name__ == "__main__":
+    platemap_metacols = ["Plate", "Well"]
+    platemap_cols = ["Reagent Identifier", "Characteristics [Cell Line]", "Control Type"]
+    probadf = probadf.merge(platemapdf[platemap_cols + platemap_metacols], how="inner", left_on=["Metadata_Plate", "Metadata_Well"], right_on=platemap_metacols)
 
-# Drop Redundant columns from merge
-probadf.drop(columns=platemap_metacols, inplace=True)
+    # Drop Redundant columns from merge
+    probadf.drop(columns=platemap_metacols, inplace=True)
 
 
 # ## Define phenotype and columns to group by
 
-# In[7]:
+# In[ ]:
 
 
-phenotype_cols = probadf.loc[:, "ADCCM":"SmallIrregular"].columns.tolist()
+# Only run as the main script (see above)
+if __name__ == "__main__":
+    phenotype_cols = probadf.loc[:, "ADCCM":"SmallIrregular"].columns.tolist()
 
-filt_cols = ['Metadata_Plate', 'Reagent Identifier', 'Metadata_Model_Type', 'Characteristics [Cell Line]', 'Metadata_Well']
+    filt_cols = ['Metadata_Plate', 'Reagent Identifier', 'Metadata_Model_Type', 'Characteristics [Cell Line]', 'Metadata_Well']
 
 
 # ## Defining tests and aggregation metric names
@@ -144,22 +190,33 @@ comp_functions = {"ks_test":  # Name of the test to perform
 
 # ## Compare treatments and negative controls
 
-# In[9]:
+# In[ ]:
+
+
+# Number of processes that compare shards (the cells of one plate and model type) at the same time
+num_workers = 4
 
+# Directory the comparisons of each shard are checkpointed in, so shards that were already compared are skipped when rerun
+comparison_shards_path = pathlib.Path(f"{big_drive_path}/class_balanced_well_log_reg_comparison_shards")
 
-treatments = sig_test.get_treatment_comparison(comp_functions,
-                                               probadf.loc[~probadf["Control Type"].isin(["negative", "no reagent"])],
-                                               probadf.loc[probadf["Control Type"] == "negative"],
-                                               phenotype_cols,
-                                               filt_cols
-                                               )
+# Only run as the main script (see above)
+if __name__ == "__main__":
+    treatments = sig_test.get_treatment_comparisons(comp_functions,
+                                                    probadf.loc[~probadf["Control Type"].isin(["negative", "no reagent"])],
+                                                    probadf.loc[probadf["Control Type"] == "negative"],
+                                                    phenotype_cols,
+                                                    filt_cols,
+                                                    comparison_shards_path,
+                                                    num_workers
+                                                    )
 
 
 # ## Save the output of the treatment
 
-# In[10]:
+# In[ ]:
 
 
-treatments = pd.DataFrame(treatments)
-treatments.to_parquet(output_path / comparison_results_output_filename)
+# Only run as the main script (see above)
+if __name__ == "__main__":
+    treatments.to_parquet(output_path / comparison_results_output_filename)
 
@@ -1,9 +1,198 @@
-from collections import defaultdict
+import hashlib
+import multiprocessing as mp
+import os
 
-def store_comparisons(_comp_functions, _treatments, _con_probs, _treatment_probs, **_comp_names):
+import numpy as np
+import pandas as pd
+from scipy.special import gammaln
+from scipy.stats import kstwo
+
+# The largest sample size for which exact KS test p-values are computed when the method is "auto" (as in scipy.stats.ks_2samp)
+MAX_EXACT_KS_SAMPLES = 10000
+
+def _ks_2samp_exact_equal(_n, _h):
+    """
+    Computes exact two-sided KS test p-values of samples with the same size for many statistics at once.
+    The p-value is 2 * (A0 - A0*A1 + A0*A1*A2 - ...), where Ak = prod_{j<h} (n - kh - j) / (n + kh + j + 1) (as in scipy.stats.ks_2samp).
+
+    Parameters
+    ----------
+    _n: Integer
+        The size of both samples
+
+    _h: numpy.ndarray
+        The statistics multiplied by the sample size (positive integers)
+
+    Returns
+    -------
+    numpy.ndarray
+        The p-value of each statistic
+    """
+
+    # Compute the log of each Ak term (terms with (k + 1) * h > n contain a zero factor)
+    k = np.arange(_n // _h.min() + 1)[:, None]
+    kh = k * _h
+    valid = kh + _h <= _n
+    kh = np.where(valid, kh, 0)
+    log_terms = np.where(valid, gammaln(_n - kh + 1) - gammaln(_n - kh - _h + 1) + gammaln(_n + kh + 1) - gammaln(_n + kh + _h + 1), -np.inf)
+
+    # Sum the alternating products of the terms
+    signs = np.where(k % 2 == 0, 1.0, -1.0)
+    return 2 * (signs * np.exp(np.cumsum(log_terms, axis=0))).sum(axis=0)
+
+def _ks_2samp_exact_inside(_m, _n, _h):
     """
-    Performs the comparisons between the control probabilities and the treatment probabilities.
-    Stores the comparisons and the desired metadata.
+    Computes exact two-sided KS test p-values of samples with different sizes for many statistics at once.
+    The number of lattice paths from (0, 0) to (m, n) that stay inside the band |x * n - y * m| < h * gcd(m, n) is counted row by row for every statistic at once,
+    and the p-value is the proportion of paths that do not stay inside this band (as in scipy.stats.ks_2samp).
+
+    Parameters
+    ----------
+    _m: Integer
+        The size of the larger sample
+
+    _n: Integer
+        The size of the smaller sample
+
+    _h: numpy.ndarray
+        The statistics multiplied by lcm(m, n) (positive integers)
+
+    Returns
+    -------
+    numpy.ndarray
+        The p-value of each statistic
+    """
+
+    g = np.gcd(_m, _n)
+    mg, ng = _m // g, _n // g
+
+    # The band of each statistic in each row x is minj <= y < maxj
+    x = np.arange(_m + 1)[:, None]
+    minj = np.clip((ng * x - _h) // mg + 1, 0, _n)
+    maxj = np.minimum(-((-(ng * x + _h)) // mg), _n + 1)
+
+    # Path counts are kept for a window of y values wide enough for the band of the largest statistic in each row
+    window_len = min(2 * int(np.ceil(_h.max() / mg)) + 2, _n + 1)
+    window_starts = np.minimum(minj.min(axis=1), _n + 1 - window_len)
+    window_y = np.arange(window_len)
+
+    counts = (window_y < maxj[0, :, None]).astype(np.float64)
+    # Counts are rescaled every few rows (each row grows counts by less than a factor of 2 ** 14), and the binary exponents of the rescaling are tracked
+    expnt = np.zeros(len(_h))
+
+    for row in range(1, _m + 1):
+        # Shift the window to the band of this row
+        shift = min(window_starts[row] - window_starts[row - 1], window_len)
+        if shift > 0:
+            counts = np.concatenate([counts[:, shift:], np.zeros((len(_h), shift))], axis=1)
+
+        # Count paths that reach each point inside the band from the previous row or the point below
+        y = window_starts[row] + window_y
+        inside = (y >= minj[row, :, None]) & (y < maxj[row, :, None])
+        counts = np.cumsum(counts * inside, axis=1) * inside
+
+        if row % 50 == 0 or row == _m:
+            _, row_expnt = np.frexp(counts.max(axis=1))
+            counts = np.ldexp(counts, -row_expnt[:, None])
+            expnt += row_expnt
+
+    # Divide the number of paths that stay inside the band by the number of all paths (binom(m + n, n))
+    with np.errstate(divide="ignore"):
+        log_inside = np.log(counts[:, _n - window_starts[_m]]) + expnt * np.log(2) - (gammaln(_m + _n + 1) - gammaln(_m + 1) - gammaln(_n + 1))
+
+    return 1 - np.exp(log_inside)
+
+def ks_2samp_batched(_con_probs, _treatment_probs, _method="auto", _con_sorted=False):
+    """
+    Performs two-sided two-sample KS tests between the control and treatment probabilities of every phenotype at once.
+    The statistics and p-values are the same as scipy.stats.ks_2samp (and scipy.stats.kstest with two samples) for each phenotype.
+
+    Parameters
+    ----------
+    _con_probs: numpy.ndarray
+        The predicted probabilities of controls, with one column for each phenotype.
+
+    _treatment_probs: numpy.ndarray
+        The predicted probabilities of the treatment, with one column for each phenotype.
+
+    _method: String
+        (Optional default="auto") How p-values are computed, either "exact", "asymp" (asymptotic), or "auto".
+        With "auto", p-values are exact if both samples have at most MAX_EXACT_KS_SAMPLES cells.
+
+    _con_sorted: Boolean
+        (Optional default=False) Whether each column of the control probabilities is already sorted.
+        The treatment probabilities are then sorted before both are merged, which is faster than sorting them together.
+
+    Returns
+    -------
+    statistics: numpy.ndarray
+        The KS statistic of each phenotype
+
+    p_values: numpy.ndarray
+        The p-value of each phenotype
+    """
+
+    n1, n2 = _con_probs.shape[0], _treatment_probs.shape[0]
+    if min(n1, n2) == 0:
+        raise ValueError("Data passed to ks_2samp_batched must not be empty")
+
+    # Sort the probabilities of both groups for each phenotype once, and find the number of cells of each group at or below each probability
+    # (a stable sort of two sorted runs only merges them)
+    if _con_sorted:
+        _treatment_probs = np.sort(_treatment_probs, axis=0)
+    all_probs = np.concatenate([_con_probs, _treatment_probs])
+    sort_idxs = np.argsort(all_probs, axis=0, kind="stable")
+    sorted_probs = np.take_along_axis(all_probs, sort_idxs, axis=0)
+    con_counts = np.cumsum(sort_idxs < n1, axis=0)
+    treatment_counts = np.arange(1, n1 + n2 + 1)[:, None] - con_counts
+
+    # The empirical CDFs are only compared after the last of equal probabilities
+    cdf_diffs = con_counts / n1 - treatment_counts / n2
+    last_equal = np.ones(sorted_probs.shape, dtype=bool)
+    last_equal[:-1] = sorted_probs[:-1] != sorted_probs[1:]
+    max_diffs = np.where(last_equal, cdf_diffs, -np.inf).max(axis=0)
+    min_diffs = np.clip(-np.where(last_equal, cdf_diffs, np.inf).min(axis=0), 0, 1)
+    statistics = np.maximum(max_diffs, min_diffs)
+
+    p_values = np.full(statistics.shape, np.nan)
+    if _method == "exact" or (_method == "auto" and max(n1, n2) <= MAX_EXACT_KS_SAMPLES):
+        # Exact p-values depend on the statistics as multiples of 1 / lcm(n1, n2)
+        lcm = np.lcm(n1, n2)
+        h = np.round(statistics * lcm).astype(np.int64)
+        statistics = h / lcm
+        p_values[h == 0] = 1.0
+
+        nonzero = h > 0
+        if nonzero.any():
+            with np.errstate(over="ignore", invalid="ignore"):
+                if n1 == n2:
+                    p_values[nonzero] = _ks_2samp_exact_equal(n1, h[nonzero])
+                else:
+                    # Statistics are counted in batches of similar sizes, so small statistics are not counted in the wide band of large statistics
+                    h_order = np.argsort(h[nonzero], kind="stable")
+                    sorted_h = h[nonzero][h_order]
+                    batch_starts = [0]
+                    for idx in range(1, len(sorted_h)):
+                        if sorted_h[idx] > 4 * sorted_h[batch_starts[-1]]:
+                            batch_starts.append(idx)
+
+                    nonzero_p_values = np.empty(len(sorted_h))
+                    for batch_start, batch_stop in zip(batch_starts, batch_starts[1:] + [len(sorted_h)]):
+                        nonzero_p_values[h_order[batch_start:batch_stop]] = _ks_2samp_exact_inside(max(n1, n2), min(n1, n2), sorted_h[batch_start:batch_stop])
+                    p_values[nonzero] = nonzero_p_values
+
+    # Use the asymptotic distribution where exact p-values are not computed or unsuccessful
+    asymp = ~((p_values >= 0) & (p_values <= 1))
+    if asymp.any():
+        en = n1 * n2 / (n1 + n2)
+        p_values[asymp] = kstwo.sf(statistics[asymp], np.round(en))
+
+    return statistics, np.clip(p_values, 0, 1)
+
+def store_comparisons(_comp_functions, _treatments, _row, _con_probs, _treatment_probs, **_comp_names):
+    """
+    Performs the comparisons between the control probabilities and the treatment probabilities of every phenotype at once.
+    Stores the comparisons and the desired metadata in the preallocated result arrays, starting at the given row.
 
     Parameters
     ----------
@@ -11,39 +200,61 @@ def store_comparisons(_comp_functions, _treatments, _con_probs, _treatment_probs
         The keys are the names of the statistical tests.
         The keys of the subdictionaries are the following strings {statistical_test_function, comparison_metric}.
 
-    _treatments: Dictionary of Lists
-        The treatment results, which contains keys corresponding to the statistical test, the comparison metric, the p value, and the comparison metric value among other keys specified by comp_names.
+    _treatments: Dictionary of numpy.ndarray
+        The preallocated treatment results, which contains keys corresponding to the statistical test, the comparison metric, the p value, and the comparison metric value among other keys specified by comp_names.
+        Arrays for the results of the statistical tests and comp_names are allocated (with the size of the statistical_test array) when they are first stored.
+
+    _row: Integer
+        The row of the result arrays to store the first comparison in.
 
-    _con_probs: pandas.Series
-        The down-sampled predicted probilities of controls for a treatment type and phenotype.
-    _treatment_probs: pandas.Series
-        The predicted probabilities of the treatment
+    _con_probs: numpy.ndarray
+        The down-sampled predicted probilities of controls for a treatment type, with one column for each phenotype.
+        Each column is sorted (columns are sorted independently, so the rows are not cells).
+
+    _treatment_probs: numpy.ndarray
+        The predicted probabilities of the treatment, with one column for each phenotype.
 
     **_comp_names: Keywork arguments
         Additional treatment data to include in the results as specified in _treatments
 
     Returns
     -------
-    _treatments: Dictionary of Lists
-        The treatment results, which contains keys corresponding to the statistical test, the comparison metric, the p value, and the comparison metric value among other keys specified by comp_names.
+    _row: Integer
+        The row after the last stored comparison
     """
-    for func_name, func_data in _comp_functions.items():
 
-        # Compute the results of the function use prespeficied parameters
+    def get_result_array(_name, _vals):
+        # Allocate the results array the first time the result is stored (strings are stored as objects)
+        if _name not in _treatments:
+            dtype = np.asarray(_vals).dtype
+            _treatments[_name] = np.empty(len(_treatments["statistical_test"]), dtype=object if dtype.kind in "OSU" else dtype)
+
+        return _treatments[_name]
+
+    num_phenos = _con_probs.shape[1]
+    num_tests = len(_comp_functions)
+    num_rows = num_phenos * num_tests
+
+    for test_idx, (func_name, func_data) in enumerate(_comp_functions.items()):
+
+        # Compute the results of the function for every phenotype at once
         results = func_data["statistical_test_function"](_con_probs, _treatment_probs)
 
-        _treatments["statistical_test"].append(func_name)
-        _treatments["comparison_metric"].append(func_data["comparison_metric"])
+        # The results of each phenotype are stored together, in the order of the tests
+        test_rows = _row + test_idx + num_tests * np.arange(num_phenos)
+
+        _treatments["statistical_test"][test_rows] = func_name
+        _treatments["comparison_metric"][test_rows] = func_data["comparison_metric"]
 
         # Store subset of results as predetermined
-        for name, val in results:
-            _treatments[name].append(val)
+        for name, vals in results:
+            get_result_array(name, vals)[test_rows] = vals
 
-        # Store the other data associated with the results
-        for name, val in _comp_names.items():
-            _treatments[name].append(val)
+    # Store the other data associated with the results
+    for name, val in _comp_names.items():
+        get_result_array(name, val)[_row:_row + num_rows] = val
 
-    return _treatments
+    return _row + num_rows
 
 def filter_wells_by_cell_count(_df, _cutoff):
     """
@@ -74,6 +285,89 @@ def filter_wells_by_cell_count(_df, _cutoff):
 
     return _df
 
+def get_samp_ranks(_well_labels, _random_state=0):
+    """
+    Finds the order the cells of each well are sampled in by DataFrame.sample with a random_state,
+    which samples the first cells of a permutation of the well seeded with the random_state.
+    The permutations are computed once, so cells can then be sampled from every well at once with strat_samp_idxs.
+
+    Parameters
+    ----------
+    _well_labels: numpy.ndarray
+        The well of each cell
+
+    _random_state: Integer
+        (Optional default=0) The random_state cells are sampled with
+
+    Returns
+    -------
+    well_codes: numpy.ndarray
+        The index of the well of each cell
+
+    well_sizes: numpy.ndarray
+        The number of cells in each well
+
+    samp_ranks: numpy.ndarray
+        The position of each cell in the sampling order of its well
+    """
+
+    well_codes, _ = pd.factorize(_well_labels)
+    well_sizes = np.bincount(well_codes)
+
+    # The cells of each well are contiguous in the stable order of the well codes
+    well_order = np.argsort(well_codes, kind="stable")
+    well_stops = np.cumsum(well_sizes)
+
+    samp_ranks = np.empty(len(well_codes), dtype=np.int64)
+    for well_start, well_stop in zip(well_stops - well_sizes, well_stops):
+        well_idxs = well_order[well_start:well_stop]
+        samp_ranks[well_idxs[np.random.RandomState(_random_state).permutation(len(well_idxs))]] = np.arange(len(well_idxs))
+
+    return well_codes, well_sizes, samp_ranks
+
+def strat_samp_idxs(_well_codes, _samp_ranks, _well_samp_counts):
+    """
+    Samples cells from every well at once, keeping the first cells in the sampling order of each well (from get_samp_ranks)
+
+    Parameters
+    ----------
+    _well_codes: numpy.ndarray
+        The index of the well of each cell
+
+    _samp_ranks: numpy.ndarray
+        The position of each cell in the sampling order of its well
+
+    _well_samp_counts: numpy.ndarray
+        The number of cells to sample from each well
+
+    Returns
+    -------
+    numpy.ndarray
+        The positions of the sampled cells (in the order of the cells)
+    """
+
+    return np.flatnonzero(_samp_ranks < _well_samp_counts[_well_codes])
+
+def get_strat_samp_counts(_well_sizes, _total_cell_count):
+    """
+    Parameters
+    ----------
+    _well_sizes: numpy.ndarray
+        The number of cells in each well
+
+    _total_cell_count: Integer
+        The cell sample size
+
+    Returns
+    -------
+    numpy.ndarray
+        The number of cells to sample from each well, which is the same fraction of cells of each well (rounded as in DataFrame.sample)
+    """
+
+    well_frac = _total_cell_count / _well_sizes.sum()
+
+    return np.round(well_frac * _well_sizes).astype(np.int64)
+
 def strat_samp_wells(_welldf, _total_cell_count):
     """
     Parameters
@@ -86,15 +380,90 @@ def strat_samp_wells(_welldf, _total_cell_count):
 
     Returns
     -------
-    The sampled cells stratified by well
+    The sampled cells stratified by well (the cells sampled by DataFrame.sample(random_state=0) from each well, in the order of _welldf)
     """
 
-    well_frac = _total_cell_count / _welldf.shape[0]
+    well_codes, well_sizes, samp_ranks = get_samp_ranks(_welldf["Metadata_Well"].to_numpy())
+
+    return _welldf.iloc[strat_samp_idxs(well_codes, samp_ranks, get_strat_samp_counts(well_sizes, _total_cell_count))]
 
-    def samp_well(_well_samp):
-        return _well_samp.sample(frac=well_frac, random_state=0)
+def get_control_cache(_negcondf, _phenotype_cols, _control_cutoff):
+    """
+    Partitions the negative control cells by plate and model type once, and caches the sorted control probabilities of each partition,
+    so every comparison with the same control cells reuses them instead of sorting the control probabilities again.
 
-    return _welldf.groupby('Metadata_Well', group_keys=False).apply(samp_well)
+    Parameters
+    ----------
+    _negcondf: pandas.Dataframe
+        The predicted probabilities and associated metadata for each cell in the negative control group.
+
+    _phenotype_cols: List
+        The names of the phenotype columns in the _negcondf dataframe.
+
+    _control_cutoff: Integer
+        The minimum number of cells required for a negative control well to be included in the comparison.
+
+    Returns
+    -------
+    control_cache: Dictionary of Dictionaries
+        The keys are (plate, model type) tuples.
+        The keys of the subdictionaries are the following strings:
+        sorted_probs (the probabilities of each phenotype column sorted), sort_idxs (the cells in the sorted order of each phenotype column),
+        and well_codes, well_sizes, and samp_ranks (the wells of the cells and the order they are sampled in with random_state=0, from get_samp_ranks).
+    """
+
+    control_cache = {}
+
+    for negcon_key, group_negdf in _negcondf.groupby(["Metadata_Plate", "Metadata_Model_Type"]):
+
+        # Remove control wells if the cell count is below the threshold
+        group_negdf = filter_wells_by_cell_count(group_negdf, _control_cutoff)
+
+        # Sort the probabilities of each phenotype once
+        con_probs = group_negdf[_phenotype_cols].to_numpy()
+        sort_idxs = np.argsort(con_probs, axis=0, kind="stable")
+
+        # Find the order cells of each well are sampled in once
+        well_codes, well_sizes, samp_ranks = get_samp_ranks(group_negdf["Metadata_Well"].to_numpy())
+
+        control_cache[negcon_key] = {
+            "sorted_probs": np.take_along_axis(con_probs, sort_idxs, axis=0),
+            "sort_idxs": sort_idxs,
+            "well_codes": well_codes,
+            "well_sizes": well_sizes,
+            "samp_ranks": samp_ranks
+        }
+
+    return control_cache
+
+def samp_sorted_controls(_con_cache, _total_cell_count):
+    """
+    Stratify samples cached control cells by well, which samples the same cells as strat_samp_wells,
+    and selects the sorted probabilities of the sampled cells without sorting them again.
+
+    Parameters
+    ----------
+    _con_cache: Dictionary
+        The cached control cells of a plate and model type from get_control_cache.
+
+    _total_cell_count: Integer
+        The cell sample size
+
+    Returns
+    -------
+    numpy.ndarray
+        The sorted probabilities of the sampled cells for each phenotype column
+    """
+
+    num_cells, num_phenos = _con_cache["sorted_probs"].shape
+
+    # Sample the same fraction of cells from every well at once
+    samp_cells = np.zeros(num_cells, dtype=bool)
+    samp_cells[strat_samp_idxs(_con_cache["well_codes"], _con_cache["samp_ranks"], get_strat_samp_counts(_con_cache["well_sizes"], _total_cell_count))] = True
+
+    # Select the sampled cells in the sorted order of each phenotype
+    samp_sorted = samp_cells[_con_cache["sort_idxs"]]
+    return _con_cache["sorted_probs"].T[samp_sorted.T].reshape(num_phenos, -1).T
 
 def get_treatment_comparison(_comp_functions, _treatdf, _negcondf, _phenotype_cols, _filt_cols, _control_cutoff = 50, _treat_cutoff = 50):
     """
@@ -132,47 +501,206 @@ def get_treatment_comparison(_comp_functions, _treatdf, _negcondf, _phenotype_co
         Contains the analysis information corresponding to each treatment
     """
 
-    treatments = defaultdict(list)
+    treatdf_groups = _treatdf.groupby(_filt_cols)
+
+    # Preallocate the result arrays for every comparison of every group, which are trimmed to the stored comparisons at the end
+    num_rows = treatdf_groups.ngroups * len(_phenotype_cols) * len(_comp_functions)
+    treatments = {"statistical_test": np.empty(num_rows, dtype=object), "comparison_metric": np.empty(num_rows, dtype=object)}
+    row = 0
+
+    # Partition the negative control cells by plate and model type, and sort their probabilities once
+    control_cache = get_control_cache(_negcondf, _phenotype_cols, _control_cutoff)
 
     # Iterate through each group
-    for filt_col_vals, group_treatdf in _treatdf.groupby(_filt_cols):
+    for filt_col_vals, group_treatdf in treatdf_groups:
 
         # The columns for keeping track of metadata and filtering the negative control cells
         ref_cols = dict(zip(_filt_cols, filt_col_vals))
 
-        # The negative control cells
-        group_negdf = _negcondf.loc[(_negcondf["Metadata_Plate"] == ref_cols["Metadata_Plate"]) &
-                                   (_negcondf["Metadata_Model_Type"] == ref_cols["Metadata_Model_Type"])
-                                    ]
+        # The cached negative control cells (with wells already filtered by cell count), or None if the plate and model type have no controls
+        group_con_cache = control_cache.get((ref_cols["Metadata_Plate"], ref_cols["Metadata_Model_Type"]))
 
         # Remove wells if the cell count is below the corresponding threshold
         group_treatdf = filter_wells_by_cell_count(group_treatdf, _treat_cutoff)
-        group_negdf = filter_wells_by_cell_count(group_negdf, _control_cutoff)
 
         # Compute the number of cells for each group
         treat_cell_count = len(group_treatdf)
-        negcon_cell_count = len(group_negdf)
+        negcon_cell_count = 0 if group_con_cache is None else len(group_con_cache["sorted_probs"])
         min_cell_count = min(treat_cell_count, negcon_cell_count)
 
         # If there are no probability values that match the given well for some reason analyze the next treatment
         if (min_cell_count > 0):
 
-            # Sample the treatment dataframe if the cell count for the treatments is larger than for the controls
+            treat_probs = group_treatdf[_phenotype_cols].to_numpy()
+
+            # Sample the treatment cells if the cell count for the treatments is larger than for the controls
+            # (the same cells as DataFrame.sample(n=min_cell_count, random_state=0), with all treatment cells as one well)
             if treat_cell_count > negcon_cell_count:
-                samp_treat = group_treatdf.sample(n=min_cell_count, random_state=0)
-                samp_neg = group_negdf
+                treat_well_codes, _, treat_samp_ranks = get_samp_ranks(np.zeros(treat_cell_count))
+                samp_treat_probs = treat_probs[strat_samp_idxs(treat_well_codes, treat_samp_ranks, np.array([min_cell_count]))]
+                samp_neg_sorted = group_con_cache["sorted_probs"]
 
             # Otherwise, keep all of the cells of the treatment group
             # Stratify sample the negative control cells by the proportion of cells in each well
             else:
-                samp_treat = group_treatdf
-                samp_neg = strat_samp_wells(group_negdf, min_cell_count)
+                samp_treat_probs = treat_probs
+                samp_neg_sorted = samp_sorted_controls(group_con_cache, min_cell_count)
 
             # Track the minimum cell count across all comparisons
             ref_cols["cell_count"] = min_cell_count
 
-            # Iterate through each possible phenotype and update the treatments variable
-            for pheno in _phenotype_cols:
-                treatments = store_comparisons(_comp_functions, treatments, samp_neg[pheno], samp_treat[pheno], **ref_cols)
+            # Compare every phenotype at once and update the treatments variable
+            row = store_comparisons(_comp_functions, treatments, row, samp_neg_sorted, samp_treat_probs, **ref_cols)
+
+    return {name: vals[:row] for name, vals in treatments.items()}
+
+def get_treatment_comparison_shard(_shard_task):
+    """
+    Helper function for get_treatment_comparisons
+    Compares the treatment and negative control cells of one shard, and saves the comparisons to the checkpoint path of the shard
+
+    Parameters
+    ----------
+    _shard_task: Tuple
+        The checkpoint path of the shard, followed by the arguments of get_treatment_comparison for the cells of the shard
+
+    Returns
+    -------
+    shard_path: pathlib.Path
+        The checkpoint path of the shard
+    """
+
+    shard_path, comparison_args = _shard_task[0], _shard_task[1:]
+    treatments = pd.DataFrame(get_treatment_comparison(*comparison_args))
+
+    # Save the comparisons to a temporary file first, so an interrupted save is not loaded as a compared shard
+    temp_shard_path = shard_path.with_name(f"{shard_path.name}.{os.getpid()}.tmp")
+    treatments.to_parquet(temp_shard_path)
+    temp_shard_path.replace(shard_path)
+
+    return shard_path
+
+def get_shard_data_hash(_shard_treatdf, _shard_negdf, _cols):
+    """
+    Hashes the cells a shard is compared with, so comparisons of a shard are only reused if its cells have not changed.
+
+    Parameters
+    ----------
+    _shard_treatdf: pandas.Dataframe
+        The treated cells of the shard.
+
+    _shard_negdf: pandas.Dataframe
+        The negative control cells of the shard.
+
+    _cols: List
+        The columns the shard is compared with (phenotype, group, and well columns).
+
+    Returns
+    -------
+    data_hash: String
+        A hash of the values (in order) of the shard's treated and negative control cells.
+    """
+    data_hash = hashlib.sha1()
+    for shard_df in [_shard_treatdf, _shard_negdf]:
+        data_hash.update(f"{len(shard_df)}:".encode())
+        data_hash.update(pd.util.hash_pandas_object(shard_df[_cols], index=False).to_numpy().tobytes())
+
+    return data_hash.hexdigest()[:10]
+
+def get_treatment_comparisons(_comp_functions, _treatdf, _negcondf, _phenotype_cols, _filt_cols, _shard_dir, _num_workers = 1, _control_cutoff = 50, _treat_cutoff = 50):
+    """
+    Compares the treatment and negative control cells as get_treatment_comparison does, in shards of plate and model type.
+    Shards are compared in parallel, and the comparisons of each shard are checkpointed in the shard directory, so shards that were already compared are skipped when this function is run again.
+    Cells are sampled with random_state=0 for each treatment group and well, so the comparisons do not depend on the shards or the number of workers.
+
+    Parameters
+    ----------
+    _comp_functions: Dictionary of Dictionaries
+        The statistical tests to perform (see get_treatment_comparison).
+
+    _treatdf: pandas.Dataframe
+        The predicted probabilities and associated metadata for each treated cell (not in a control group).
+
+    _negcondf: pandas.Dataframe
+        The predicted probabilities and associated metadata for each cell in the negative control group.
+
+    _phenotype_cols: List
+        The names of the phenotype columns in the _treatdf and _negcondf dataframes.
+
+    _filt_cols: List
+        The names of the columns to group the treatment cells by before comparing the probabilities.
+
+    _shard_dir: pathlib.Path
+        The directory to checkpoint the comparisons of each shard in.
+        Shards are saved with a hash of the comparison settings and a hash of the shard's cells, so shards compared with other settings or other probability data are not reused.
+        Shards of the same plate and model type compared with the same settings but other probability data are removed when the shard is compared again.
+
+    _num_workers: Integer
+        (Optional default=1) The number of processes that compare shards at the same time.
+
+    _control_cutoff: Integer
+        (Optional default=50) The minimum number of cells required for a negative control well to be included in the comparison.
+
+    _treat_cutoff: Integer
+        (Optional default=50) The minimum number of cells required for a treatment well (excluding negative control wells) to be included in the comparison.
+
+    Returns
+    -------
+    treatments: pandas.Dataframe
+        Contains the analysis information corresponding to each treatment (in the same order as get_treatment_comparison)
+    """
+
+    shard_cols = ["Metadata_Plate", "Metadata_Model_Type"]
+
+    # Hash the comparison settings, so shards compared with other settings are not reused
+    comp_settings = [(func_name, func_data["comparison_metric"]) for func_name, func_data in _comp_functions.items()]
+    settings_hash = hashlib.sha1(repr((comp_settings, list(_phenotype_cols), list(_filt_cols), _control_cutoff, _treat_cutoff)).encode()).hexdigest()[:10]
+    _shard_dir.mkdir(parents=True, exist_ok=True)
+
+    # Columns the cells of a shard are compared with (cells are also filtered and sampled by well)
+    data_cols = list(dict.fromkeys(list(_phenotype_cols) + list(_filt_cols) + shard_cols + ["Metadata_Well"]))
+
+    # Each shard only needs the negative control cells of its plate and model type
+    negcon_shards = {shard_key: shard_negdf for shard_key, shard_negdf in _negcondf.groupby(shard_cols)}
+
+    shard_paths = []
+    shard_tasks = []
+    for shard_key, shard_treatdf in _treatdf.groupby(shard_cols):
+        shard_negdf = negcon_shards.get(shard_key, _negcondf.iloc[:0])
+
+        # Hash the cells of the shard, so shards are compared again if the probability data changes (for example after cells are classified again)
+        data_hash = get_shard_data_hash(shard_treatdf, shard_negdf, data_cols)
+        shard_prefix = f"{shard_key[0]}__{shard_key[1]}__{settings_hash}__"
+        shard_path = _shard_dir / f"{shard_prefix}{data_hash}.parquet"
+        shard_paths.append(shard_path)
+
+        # Skip shards that were already compared
+        if shard_path.is_file():
+            continue
+
+        # Remove shards compared with previous probability data
+        for stale_shard_path in _shard_dir.glob(f"{shard_prefix}*.parquet"):
+            stale_shard_path.unlink()
+
+        shard_tasks.append((shard_path, _comp_functions, shard_treatdf, shard_negdf, _phenotype_cols, _filt_cols, _control_cutoff, _treat_cutoff))
+
+    print(f"Comparing {len(shard_tasks)} of {len(shard_paths)} shards ({len(shard_paths) - len(shard_tasks)} were already compared)")
+
+    if _num_workers > 1:
+        with mp.Pool(processes=_num_workers) as pool:
+            for shard_path in pool.imap_unordered(get_treatment_comparison_shard, shard_tasks):
+                print(f"Compared shard {shard_path.name}")
+    else:
+        for shard_task in shard_tasks:
+            shard_path = get_treatment_comparison_shard(shard_task)
+            print(f"Compared shard {shard_path.name}")
+
+    # Merge the shards with comparisons (shards without comparisons, such as plates without negative control cells, have no result columns)
+    shard_treatments = [pd.read_parquet(shard_path) for shard_path in shard_paths]
+    shard_treatments = [treatments for treatments in shard_treatments if len(treatments) > 0]
+    if len(shard_treatments) == 0:
+        return pd.DataFrame()
+    treatments = pd.concat(shard_treatments, ignore_index=True)
 
-    return treatments
+    # Order the comparisons by group as get_treatment_comparison does
+    return treatments.sort_values(_filt_cols, kind="stable").reset_index(drop=True)
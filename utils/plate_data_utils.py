@@ -0,0 +1,466 @@
+"""
+utils for the single-cell plate data format shared by all modules
+(saved by 3.preprocess-features and 4.classify-single-cell-phenotypes, and loaded by these modules and 5.analyze-data)
+"""
+
+import pathlib
+import shutil
+import time
+import uuid
+from typing import Dict, Iterator, List, Literal, Optional, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+# plate data saved as parquet is partitioned into plate/well folders
+PLATE_DATA_PARTITIONING = ds.partitioning(
+    pa.schema([("Metadata_Plate", pa.string()), ("Metadata_Well", pa.string())]),
+    flavor="hive",
+)
+
+# feature types models can be trained with, each using a group of feature columns
+FEATURE_TYPES = ["CP", "DP", "CP_and_DP", "CP_areashape_only", "CP_zernike_only"]
+
+# combined classifications saved as uint16 are probabilities quantized to multiples of 1/65535
+QUANTIZED_PROBA_SCALE = 65535
+
+
+def get_plate_names(
+    plate_data_path: pathlib.Path, file_format: Literal["csv.gz", "parquet"] = "csv.gz"
+) -> List[str]:
+    """
+    get names of plates saved in plate data folder (csv.gz) or parquet dataset
+
+    Parameters
+    ----------
+    plate_data_path : pathlib.Path
+        path to folder with {plate}-*.csv.gz files or to parquet dataset folder
+    file_format : Literal["csv.gz", "parquet"], optional
+        format plate data is saved in, by default "csv.gz"
+
+    Returns
+    -------
+    List[str]
+        sorted plate names
+    """
+
+    if file_format == "parquet":
+        # plate partition folders are named Metadata_Plate={plate}
+        return sorted(
+            plate_partition_path.name.split("=")[1]
+            for plate_partition_path in plate_data_path.glob("Metadata_Plate=*")
+        )
+
+    return sorted(
+        plate_data_file.name.split("-")[0]
+        for plate_data_file in plate_data_path.glob(f"*.{file_format}")
+    )
+
+
+def get_plate_data_columns(
+    plate_data_path: pathlib.Path, file_format: Literal["csv.gz", "parquet"] = "csv.gz"
+) -> List[str]:
+    """
+    get column names of plate data without loading the data
+
+    Parameters
+    ----------
+    plate_data_path : pathlib.Path
+        path to compressed csv file with plate data or to parquet dataset folder
+    file_format : Literal["csv.gz", "parquet"], optional
+        format plate data is saved in, by default "csv.gz"
+
+    Returns
+    -------
+    List[str]
+        plate data column names
+    """
+
+    if file_format == "parquet":
+        return ds.dataset(
+            plate_data_path, format="parquet", partitioning=PLATE_DATA_PARTITIONING
+        ).schema.names
+
+    return pd.read_csv(plate_data_path, nrows=0).columns.to_list()
+
+
+def get_plate_schema_path(
+    plate_data_path: pathlib.Path,
+    plate: str,
+    file_format: Literal["csv.gz", "parquet"] = "csv.gz",
+) -> pathlib.Path:
+    """
+    get path to schema saved with plate data ({plate}-*.csv.schema.npz or {plate}-*.parquet.schema.npz next to the compressed csv file or parquet dataset folder)
+
+    Parameters
+    ----------
+    plate_data_path : pathlib.Path
+        path to compressed csv file with plate data or to parquet dataset folder
+    plate : str
+        name of plate to get schema path for
+    file_format : Literal["csv.gz", "parquet"], optional
+        format plate data is saved in, by default "csv.gz"
+
+    Returns
+    -------
+    pathlib.Path
+        path to plate schema
+    """
+
+    if file_format == "parquet":
+        return pathlib.Path(
+            f"{plate_data_path.parent}/{plate}-{plate_data_path.name}.schema.npz"
+        )
+
+    return pathlib.Path(
+        f"{plate_data_path.parent}/{plate_data_path.name.replace('.csv.gz', '.csv')}.schema.npz"
+    )
+
+
+def get_plate_schema(
+    plate_data_columns: List[str], plate_data_dtypes: List[str]
+) -> dict:
+    """
+    get schema of plate data with the positions of the feature columns used by each feature type,
+    so columns only need to be scanned once (when plate data is saved)
+
+    Parameters
+    ----------
+    plate_data_columns : List[str]
+        plate data column names (in saved order)
+    plate_data_dtypes : List[str]
+        dtypes plate data columns are loaded as
+
+    Returns
+    -------
+    dict
+        columns, dtypes, feature_indices (positions of all feature columns),
+        and feature_type_indices (feature type -> positions of feature columns used by feature type)
+    """
+
+    is_feature_col = np.array(["P__" in col for col in plate_data_columns], dtype=bool)
+    is_cp_col = np.array(["CP__" in col for col in plate_data_columns], dtype=bool)
+    is_dp_col = np.array(["DP__" in col for col in plate_data_columns], dtype=bool)
+    is_zernike_col = np.array(
+        ["Zernike" in col for col in plate_data_columns], dtype=bool
+    )
+    is_areashape_col = np.array(
+        ["AreaShape" in col for col in plate_data_columns], dtype=bool
+    )
+
+    return {
+        "columns": list(plate_data_columns),
+        "dtypes": list(plate_data_dtypes),
+        "feature_indices": np.flatnonzero(is_feature_col),
+        "feature_type_indices": {
+            "CP": np.flatnonzero(is_cp_col),
+            "DP": np.flatnonzero(is_dp_col),
+            "CP_and_DP": np.flatnonzero(is_feature_col),
+            "CP_areashape_only": np.flatnonzero(is_cp_col & is_areashape_col),
+            "CP_zernike_only": np.flatnonzero(is_cp_col & is_zernike_col),
+        },
+    }
+
+
+def save_plate_schema(plate_schema: dict, save_path: pathlib.Path) -> None:
+    """
+    save plate schema as an npz file with columns, dtypes, and column index arrays
+
+    Parameters
+    ----------
+    plate_schema : dict
+        plate schema derived with get_plate_schema
+    save_path : pathlib.Path
+        path to npz file to save plate schema to
+    """
+
+    np.savez(
+        save_path,
+        columns=np.array(plate_schema["columns"], dtype=str),
+        dtypes=np.array(plate_schema["dtypes"], dtype=str),
+        feature_indices=plate_schema["feature_indices"],
+        **{
+            f"{feature_type}_indices": feature_type_indices
+            for feature_type, feature_type_indices in plate_schema[
+                "feature_type_indices"
+            ].items()
+        },
+    )
+
+
+def load_plate_schema(
+    plate_data_path: pathlib.Path,
+    plate: str,
+    file_format: Literal["csv.gz", "parquet"] = "csv.gz",
+) -> dict:
+    """
+    load schema saved with plate data.
+    if plate data was saved without a schema, the schema is derived from the plate data columns
+
+    Parameters
+    ----------
+    plate_data_path : pathlib.Path
+        path to compressed csv file with plate data or to parquet dataset folder
+    plate : str
+        name of plate to load schema for
+    file_format : Literal["csv.gz", "parquet"], optional
+        format plate data is saved in, by default "csv.gz"
+
+    Returns
+    -------
+    dict
+        columns, dtypes, feature_indices (positions of all feature columns),
+        and feature_type_indices (feature type -> positions of feature columns used by feature type)
+    """
+
+    plate_schema_path = get_plate_schema_path(plate_data_path, plate, file_format)
+    if not plate_schema_path.is_file():
+        plate_data_columns = get_plate_data_columns(plate_data_path, file_format)
+        return get_plate_schema(
+            plate_data_columns,
+            ["float32" if "P__" in col else "str" for col in plate_data_columns],
+        )
+
+    with np.load(plate_schema_path) as plate_schema:
+        return {
+            "columns": plate_schema["columns"].tolist(),
+            "dtypes": plate_schema["dtypes"].tolist(),
+            "feature_indices": plate_schema["feature_indices"],
+            "feature_type_indices": {
+                feature_type: plate_schema[f"{feature_type}_indices"]
+                for feature_type in FEATURE_TYPES
+            },
+        }
+
+
+def save_plate_data(
+    plate_data: pd.DataFrame,
+    save_path: pathlib.Path,
+    file_format: Literal["csv.gz", "parquet"] = "csv.gz",
+    append: bool = False,
+    index: bool = False,
+) -> None:
+    """
+    save single-cell plate data to a compressed csv file or to a parquet dataset partitioned by plate and well.
+    in the parquet dataset, features are saved as float32 and metadata is dictionary encoded.
+    a schema of the plate data is saved next to it (see get_plate_schema_path) so columns do not need to be scanned when it is loaded
+
+    Parameters
+    ----------
+    plate_data : pd.DataFrame
+        single-cell data from one plate (must have a Metadata_Plate column, and a Metadata_Well column to save as parquet)
+    save_path : pathlib.Path
+        path to compressed csv file or to parquet dataset folder (shared by all plates)
+    file_format : Literal["csv.gz", "parquet"], optional
+        format to save plate data in, by default "csv.gz"
+    append : bool, optional
+        whether to add plate data to data already saved for the plate (when a plate is saved in parts), by default False
+    index : bool, optional
+        whether to save dataframe index as the first column (only used for csv.gz, the index is not in the schema), by default False
+
+    Raises
+    ------
+    ValueError
+        thrown if file format is not csv.gz or parquet
+    """
+
+    if file_format == "csv.gz":
+        plate_data.to_csv(
+            save_path,
+            mode="a" if append else "w",
+            header=not append,
+            compression="gzip",
+            index=index,
+        )
+    elif file_format == "parquet":
+        plate_data = plate_data.copy()
+        for col in plate_data.columns:
+            if col in ["Metadata_Plate", "Metadata_Well"]:
+                # partition values are saved as folder names
+                plate_data[col] = plate_data[col].astype(str)
+            elif pd.api.types.is_float_dtype(plate_data[col]):
+                if not col.startswith("Location_"):
+                    plate_data[col] = plate_data[col].astype(np.float32)
+            elif not pd.api.types.is_numeric_dtype(plate_data[col]):
+                plate_data[col] = plate_data[col].astype("category")
+
+        # remove data previously saved for the plate unless adding to it
+        if not append:
+            for plate in plate_data["Metadata_Plate"].unique():
+                shutil.rmtree(
+                    pathlib.Path(f"{save_path}/Metadata_Plate={plate}"),
+                    ignore_errors=True,
+                )
+
+        ds.write_dataset(
+            pa.Table.from_pandas(plate_data, preserve_index=False),
+            save_path,
+            format="parquet",
+            partitioning=["Metadata_Plate", "Metadata_Well"],
+            partitioning_flavor="hive",
+            # file names start with the time they are saved so data is loaded in the order it was saved
+            basename_template=f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+    else:
+        raise ValueError(f"file_format must be csv.gz or parquet, not {file_format}")
+
+    # save schema with plate data so columns do not need to be scanned when it is loaded
+    if not append:
+        if file_format == "parquet":
+            plate_data_dtypes = plate_data.dtypes.astype(str).to_list()
+        else:
+            # csv features are loaded as float32 and csv metadata as str, other columns (like class probabilities) keep their dtype
+            plate_data_dtypes = [
+                "float32"
+                if "P__" in col
+                else "str"
+                if col.startswith(("Metadata_", "Location_"))
+                else str(plate_data[col].dtype)
+                for col in plate_data.columns
+            ]
+        plate_schema = get_plate_schema(plate_data.columns.to_list(), plate_data_dtypes)
+        for plate in plate_data["Metadata_Plate"].unique():
+            save_plate_schema(
+                plate_schema, get_plate_schema_path(save_path, plate, file_format)
+            )
+
+
+def get_combined_classifications(
+    plate_metadata: pd.DataFrame,
+    plate_models_probas: Dict[str, pd.DataFrame],
+    classifications_dtype: Literal["float32", "uint16"] = "float32",
+) -> pd.DataFrame:
+    """
+    combine single-cell metadata with probabilities from all models, so metadata is only saved once.
+    probability columns are named {model_name}/{phenotypic_class}
+
+    Parameters
+    ----------
+    plate_metadata : pd.DataFrame
+        single-cell metadata
+    plate_models_probas : Dict[str, pd.DataFrame]
+        model names, each with dataframe of single-cell probabilities
+    classifications_dtype : Literal["float32", "uint16"], optional
+        data type to save probabilities as, by default "float32".
+        uint16 probabilities are quantized to multiples of 1/65535 (load_model_classifications converts them back to float32)
+
+    Returns
+    -------
+    pd.DataFrame
+        single-cell metadata and probabilities from all models
+    """
+
+    combined_classifications = [plate_metadata]
+    for model_name, plate_probas in plate_models_probas.items():
+        probas = plate_probas.to_numpy(dtype=np.float32)
+        if classifications_dtype == "uint16":
+            probas = np.rint(probas * QUANTIZED_PROBA_SCALE).astype(np.uint16)
+        combined_classifications.append(
+            pd.DataFrame(
+                probas,
+                columns=[
+                    f"{model_name}/{phenotypic_class}"
+                    for phenotypic_class in plate_probas.columns
+                ],
+                index=plate_metadata.index,
+            )
+        )
+
+    return pd.concat(combined_classifications, axis=1)
+
+
+def get_classification_model_names(classifications_path: pathlib.Path) -> List[str]:
+    """
+    get names of models with classifications in combined classifications dataset
+
+    Parameters
+    ----------
+    classifications_path : pathlib.Path
+        path to combined classifications parquet dataset
+
+    Returns
+    -------
+    List[str]
+        model names (in order they were saved)
+    """
+
+    model_names = []
+    for col in get_plate_data_columns(classifications_path, "parquet"):
+        if "/" in col and col.rsplit("/", 1)[0] not in model_names:
+            model_names.append(col.rsplit("/", 1)[0])
+
+    return model_names
+
+
+def load_model_classifications(
+    classifications_path: pathlib.Path,
+    plate: Optional[str],
+    model_name: str,
+    metadata_cols: List[str],
+    chunksize: Optional[int] = None,
+) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+    """
+    load single-cell probabilities of one model from combined classifications dataset.
+    only the model's probability columns and the given metadata columns are read
+
+    Parameters
+    ----------
+    classifications_path : pathlib.Path
+        path to combined classifications parquet dataset
+    plate : Optional[str]
+        name of plate to load classifications for, or None to load classifications for all plates
+    model_name : str
+        name of model to load classifications for
+    metadata_cols : List[str]
+        metadata columns to load with classifications
+    chunksize : Optional[int], optional
+        number of cells to load at a time, by default None (load all cells at once)
+
+    Returns
+    -------
+    Union[pd.DataFrame, Iterator[pd.DataFrame]]
+        single-cell metadata and float32 probabilities (columns named by phenotypic class),
+        or iterator of chunks of these if chunksize is given
+    """
+
+    classifications_dataset = ds.dataset(
+        classifications_path, format="parquet", partitioning=PLATE_DATA_PARTITIONING
+    )
+    model_cols = [
+        col
+        for col in classifications_dataset.schema.names
+        if col.startswith(f"{model_name}/")
+    ]
+    plate_filter = None if plate is None else ds.field("Metadata_Plate") == plate
+
+    def format_model_classifications(
+        model_classifications: pd.DataFrame,
+    ) -> pd.DataFrame:
+        # convert quantized probabilities back to float32
+        for col in model_cols:
+            if model_classifications[col].dtype == np.uint16:
+                model_classifications[col] = model_classifications[col].to_numpy(
+                    dtype=np.float32
+                ) / np.float32(QUANTIZED_PROBA_SCALE)
+
+        return model_classifications.rename(
+            columns={col: col[len(model_name) + 1 :] for col in model_cols}
+        )
+
+    if chunksize is None:
+        return format_model_classifications(
+            classifications_dataset.to_table(
+                columns=metadata_cols + model_cols, filter=plate_filter
+            ).to_pandas()
+        )
+    return (
+        format_model_classifications(model_classifications_batch.to_pandas())
+        for model_classifications_batch in classifications_dataset.to_batches(
+            columns=metadata_cols + model_cols,
+            filter=plate_filter,
+            batch_size=chunksize,
+        )
+    )
@@ -0,0 +1,45 @@
+"""
+utils for processing tasks in parallel within a memory budget, shared by all modules
+"""
+
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+
+def get_task_batches(
+    tasks: Iterable[Any], task_bytes: Callable, memory_budget_gb: Optional[float]
+) -> Iterator[List[Any]]:
+    """
+    split tasks into batches that are estimated to fit in a memory budget when processed at the same time
+
+    Parameters
+    ----------
+    tasks : Iterable[Any]
+        tasks to split into batches (consumed lazily)
+    task_bytes : Callable
+        function that estimates the number of bytes needed to process a task
+    memory_budget_gb : Optional[float]
+        memory budget (in GB) for each batch, by default None (all tasks are put in one batch).
+        a task that is larger than the budget on its own is put in a batch by itself
+
+    Yields
+    ------
+    Iterator[List[Any]]
+        batches of tasks (in the order tasks are given)
+    """
+
+    if memory_budget_gb is None:
+        yield list(tasks)
+        return
+
+    memory_budget_bytes = memory_budget_gb * 1024**3
+    batch, batch_bytes = [], 0
+    for task in tasks:
+        current_task_bytes = task_bytes(task)
+        if len(batch) > 0 and batch_bytes + current_task_bytes > memory_budget_bytes:
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(task)
+        batch_bytes += current_task_bytes
+
+    if len(batch) > 0:
+        yield batch